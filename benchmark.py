@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+benchmark.py
+Times data_accessioner.py on generated donation trees and writes the results
+as JSON, so runs can be compared between versions.
+'''
+import datetime, time
+import getopt
+import json
+import os, sys, platform
+import random
+import shutil
+import tempfile
+
+import data_accessioner
+
+# Characters mixed into generated names: ones chars_to_remove replaces, ones
+# the accessioner deletes, ones cp850 can encode and ones it can't
+SPECIAL_CHARACTERS = u" :'+=,!@#$%^&*()[]"
+SYMBOL_CHARACTERS = u"®©™"
+CP850_CHARACTERS = u"éèüñçøåÆ"
+OTHER_CHARACTERS = u"ąłő中文日本語ΩЖ"
+EXTENSIONS = [".txt", ".doc", ".pdf", ".jpg", ".tif", ".xls", ".wav", ".000", ""]
+
+PROFILES = ["wide", "deep", "unicode", "tiny", "huge"]
+
+def generate_tree(top_dir, profile, scale=1.0, seed=0):
+    """ Fills top_dir with a donation tree of the given profile, scale times
+    its usual size, the same every time for the same seed:
+    wide: one bag holding thousands of files in a single folder
+    deep: bags of long chains of nested folders with a few files each
+    unicode: names full of special and non-ascii characters, many of which
+        cleanse to the same name, in bags with such names and one without
+    tiny: many bags of many tiny files, plus loose files in top_dir
+    huge: a few large files
+    Returns the number of files and bytes written. """
+    rand = random.Random(seed)
+    block = "".join(chr(rand.randint(0, 255)) for i in range(65536))
+    files, size = 0, 0
+    if profile == "wide":
+        bag = os.path.join(top_dir, "Wide Donation")
+        os.makedirs(bag)
+        for i in range(int(5000 * scale)):
+            size += write_file(os.path.join(bag, "scan %05d%s" % (i, rand.choice(EXTENSIONS))), rand.randint(0, 2048), block)
+            files += 1
+    elif profile == "deep":
+        for b in range(4):
+            dir_path = os.path.join(top_dir, "Deep Donation %d" % b)
+            for depth in range(int(50 * scale)):
+                dir_path = os.path.join(dir_path, "level (%d)" % depth)
+                os.makedirs(dir_path)
+                for i in range(3):
+                    size += write_file(os.path.join(dir_path, "item %d.txt" % i), rand.randint(0, 1024), block)
+                    files += 1
+    elif profile == "unicode":
+        for b in range(4):
+            bag = os.path.join(top_dir, random_name(rand) + u" ®")
+            if b == 0:
+                # an ascii name, so the bag's non-ascii contents are listed through a path 
+                # Python 2 keeps as unicode under a non-UTF-8 locale (LANG unset)
+                bag = os.path.join(top_dir, u"Plain Donation")
+            dir_paths = [bag]
+            os.makedirs(bag.encode('utf-8'))
+            for i in range(int(500 * scale)):
+                if rand.random() < 0.1:
+                    dir_path = os.path.join(rand.choice(dir_paths), random_name(rand))
+                    if not os.path.exists(dir_path.encode('utf-8')):
+                        os.mkdir(dir_path.encode('utf-8'))
+                        dir_paths.append(dir_path)
+                    continue
+                file_path = os.path.join(rand.choice(dir_paths), random_name(rand) + rand.choice(EXTENSIONS))
+                if not os.path.exists(file_path.encode('utf-8')):
+                    size += write_file(file_path.encode('utf-8'), rand.randint(0, 1024), block)
+                    files += 1
+    elif profile == "tiny":
+        for b in range(20):
+            bag = os.path.join(top_dir, "Tiny Donation %02d" % b)
+            for d in range(5):
+                os.makedirs(os.path.join(bag, "folder %d" % d))
+            for i in range(int(500 * scale)):
+                file_path = os.path.join(bag, "folder %d" % rand.randint(0, 4), "note %04d.txt" % i)
+                size += write_file(file_path, rand.randint(0, 100), block)
+                files += 1
+        for i in range(5):
+            size += write_file(os.path.join(top_dir, "loose file (%d).txt" % i), 100, block)
+            files += 1
+    elif profile == "huge":
+        bag = os.path.join(top_dir, "Huge Donation")
+        os.makedirs(bag)
+        for i in range(3):
+            size += write_file(os.path.join(bag, "disk image %d.iso" % i), int(64 * 1048576 * scale), block)
+            files += 1
+    else:
+        raise ValueError("unknown profile " + profile)
+    return files, size
+
+def random_name(rand):
+    """ Returns a short unicode name made of letters and the characters above,
+    from a small alphabet so that many names cleanse to the same one. """
+    alphabet = u"abc" + SPECIAL_CHARACTERS + SYMBOL_CHARACTERS + CP850_CHARACTERS + OTHER_CHARACTERS
+    return u"".join(rand.choice(alphabet) for i in range(rand.randint(1, 6))).strip() or u"x"
+
+def write_file(path, size, block):
+    """ Writes a file of size bytes at path, repeating block. Returns size. """
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            f.write(block[:size - written])
+            written += len(block)
+    return size
+
+class NullWriter(object):
+    """ A stand-in for sys.stdout that drops whatever is printed to it, str or
+    unicode alike (a file opened on os.devnull encodes unicode as ascii). """
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+class LatencyFileOps(data_accessioner.FileOps):
+    """ FileOps that waits latency seconds before each file system call, a
+    stand-in for a network share where every call is a round trip. """
+    def __init__(self, latency, workers=1):
+        data_accessioner.FileOps.__init__(self, workers)
+        self.latency = latency
+
+def delayed(name):
+    """ Returns FileOps' method name, waiting LatencyFileOps.latency first. """
+    method = getattr(data_accessioner.FileOps, name)
+    def delayed_method(self, *args):
+        time.sleep(self.latency)
+        return method(self, *args)
+    return delayed_method
+
+for name in ["listdir", "scandir", "stat_entry", "stat", "lstat", "exists", "isfile", "readlink", "mkdir", "rename", "move", "open"]:
+    setattr(LatencyFileOps, name, delayed(name))
+
+def run_benchmark(profile, scale, workers, manifest_algorithms, settings_file, keep_dir=None, \
+    io_workers=1, latency=0, identify=False, dedupe=False, package=False, compression=None):
+    """ Generates a tree of the given profile in a temporary folder, accessions
+    it and returns the timings: the whole of accession_bags_in_dir() and the
+    totals of each stage over the bags from its RunReport. The accessioner's
+    file system calls run io_workers at a time, each latency seconds late. 
+    With package, the bags are packaged into the temporary folder too. """
+    work_dir = tempfile.mkdtemp(prefix="accession_benchmark_")
+    top_dir = os.path.join(work_dir, profile)
+    os.mkdir(top_dir)
+    try:
+        start = time.time()
+        files, size = generate_tree(top_dir, profile, scale)
+        generate_seconds = time.time() - start
+
+        accessioner = data_accessioner.DataAccessioner(settings_file)
+        accessioner.manifest_algorithms = manifest_algorithms
+        accessioner.identify_formats = identify
+        accessioner.detect_duplicates = dedupe
+        if package:
+            accessioner.package_dir = os.path.join(work_dir, "packages")
+            accessioner.package_compression = compression
+            os.mkdir(accessioner.package_dir)
+        accessioner.run_report = data_accessioner.RunReport()
+        fs = data_accessioner.fs
+        data_accessioner.fs = LatencyFileOps(latency, io_workers)
+        # the accessioner prints a line or more per bag
+        stdout, sys.stdout = sys.stdout, NullWriter()
+        try:
+            start = time.time()
+            accessioner.accession_bags_in_dir(top_dir, workers=workers)
+            seconds = time.time() - start
+        finally:
+            sys.stdout = stdout
+            data_accessioner.fs = fs
+
+        summary = accessioner.run_report.summary()
+        return {"profile": profile, "files": files, "bytes": size,
+            "generate_seconds": generate_seconds, "seconds": seconds,
+            "files_per_second": files / seconds if seconds else None,
+            "calls": summary["calls"], "stages": summary["stages"]}
+    finally:
+        if keep_dir is not None:
+            shutil.move(top_dir, os.path.join(keep_dir, os.path.basename(work_dir)))
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare_results(old_results, new_results):
+    """ Prints the time taken for each profile in new_results next to the time
+    in old_results, best of the repeats. """
+    def best(results):
+        times = {}
+        for run in results["runs"]:
+            times[run["profile"]] = min(times.get(run["profile"], run["seconds"]), run["seconds"])
+        return times
+    old_times, new_times = best(old_results), best(new_results)
+    for profile in sorted(new_times):
+        if profile in old_times:
+            print "%-8s %8.2f s -> %8.2f s (%+.0f%%)" % (profile, old_times[profile], new_times[profile], \
+                100.0 * (new_times[profile] - old_times[profile]) / old_times[profile])
+
+def usage_message():
+    print "\nbenchmark: Times data_accessioner.py on generated donation trees.\
+    \n\nUsage:\
+            \n\tpython benchmark.py [options]\
+        \n\nOptions:\
+            \n\t-h --help\tShow this screen.\
+            \n\t-p P --profiles=P\tComma separated profiles to run (default all):\
+            \n\t\t\t" + ", ".join(PROFILES) + ".\
+            \n\t-s X --scale=X\tMakes the trees X times their usual size (default 1).\
+            \n\t-r N --repeat=N\tRuns each profile N times (default 1).\
+            \n\t-w N --workers=N\tAccessions N bags at once (default 1).\
+            \n\t-m ALGS --manifest=ALGS\tWrites BagIt manifests with hash algorithms ALGS.\
+            \n\t--identify\tIdentifies the formats of the files.\
+            \n\t--dedupe\tLooks for duplicate files.\
+            \n\t--package\tPackages the bags into tar files.\
+            \n\t--compress=ALG\tCompresses the packages with gzip or zstd.\
+            \n\t--io-workers=N\tRuns N file system calls at once (default 8).\
+            \n\t--latency=MS\tDelays every file system call by MS milliseconds, like a\
+            \n\t\t\tnetwork share would (default 0).\
+            \n\t-o FILE --output=FILE\tWrites the results as JSON to FILE\
+            \n\t\t\t(default benchmark_<date>.json).\
+            \n\t--compare=FILE\tCompares the results with earlier ones in FILE.\
+            \n\t--keep=DIR\tMoves the accessioned trees to DIR instead of deleting them."
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:s:r:w:m:o:", ["help", "profiles=", "scale=", \
+            "repeat=", "workers=", "manifest=", "output=", "compare=", "keep=", "io-workers=", "latency=", "identify", "dedupe", "package", "compress="])
+    except getopt.GetoptError as err:
+        print '\n' + str(err),
+        return usage_message()
+    opts = dict(opts)
+    if args or "-h" in opts or "--help" in opts:
+        return usage_message()
+
+    profiles = opts.get("-p", opts.get("--profiles", ",".join(PROFILES))).split(",")
+    for profile in profiles:
+        if profile not in PROFILES:
+            print '\nunknown profile', profile,
+            return usage_message()
+    try:
+        scale = float(opts.get("-s", opts.get("--scale", 1)))
+        repeat = int(opts.get("-r", opts.get("--repeat", 1)))
+        workers = int(opts.get("-w", opts.get("--workers", 1)))
+        io_workers = int(opts.get("--io-workers", data_accessioner.fs.workers))
+        latency = float(opts.get("--latency", 0)) / 1000
+    except ValueError:
+        print '\n--scale, --repeat, --workers, --io-workers and --latency must be numbers',
+        return usage_message()
+    manifest_algorithms = opts.get("-m", opts.get("--manifest"))
+    manifest_algorithms = manifest_algorithms.lower().split(",") if manifest_algorithms else []
+
+    now = datetime.datetime.now()
+    output = opts.get("-o", opts.get("--output", "benchmark_%s%02d%02d_%02d%02d%02d.json" % (now.year, \
+        now.month, now.day, now.hour, now.minute, now.second)))
+    settings_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "accession_settings.txt")
+
+    results = {"date": str(now), "python": platform.python_version(), "platform": platform.platform(),
+        "scale": scale, "workers": workers, "manifest": manifest_algorithms,
+        "io_workers": io_workers, "latency": latency, "identify": "--identify" in opts,
+        "dedupe": "--dedupe" in opts, "package": "--package" in opts, "compress": opts.get("--compress"),
+        "runs": []}
+    # the results are written after each run, so a failed or interrupted run keeps the ones before it
+    for profile in profiles:
+        for i in range(repeat):
+            run = run_benchmark(profile, scale, workers, manifest_algorithms, settings_file, opts.get("--keep"), \
+                io_workers, latency, "--identify" in opts, "--dedupe" in opts, "--package" in opts, opts.get("--compress"))
+            results["runs"].append(run)
+            print "%-8s %7d files %10d bytes %8.2f s  (%s)" % (profile, run["files"], run["bytes"], run["seconds"], \
+                ", ".join("%s %.2f" % (stage, run["stages"][stage]["seconds"]) for stage in sorted(run["stages"])))
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    print "results written to", output
+
+    if "--compare" in opts:
+        with open(opts["--compare"]) as f:
+            compare_results(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
@@ -7,24 +7,77 @@ liam.m.everett@gmail.com
     Edited by Sahree Kasper
     sahreek@gmail.com
 '''
+import array
 import ast
+import collections
+import contextlib
 import csv
+import codecs
+import ctypes, ctypes.util
 import datetime, time
+import encodings.cp850
+import fnmatch
+# imported up front: datetime.strptime() imports it lazily, which fails in worker threads
+import _strptime
+import getopt
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os, sys, platform
+import Queue
 import re, string
+import select
 import shutil
+import sqlite3
+import stat
+import struct
+import tarfile
+import threading
+import traceback
+import zlib
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+# ioctl to clone a file on Linux, from linux/fs.h
+FICLONE = 0x40049409
+# inotify events FolderWatcher waits for, from sys/inotify.h
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2: https://pypi.python.org/pypi/scandir
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    # https://pypi.python.org/pypi/zstandard, only needed for zstd compressed packages
+    import zstandard
+except ImportError:
+    zstandard = None
 
 class DataAccessioner:
     def __init__(self,settings_file):
-        self.excludes, self.excludes_regex = [], []
+        self.excludes, self.excludes_regex, self.excludes_glob = [], [], []
         self.storage_location_name = ""
+        # Files are indexed in this database if it is set, shared by top directories, see DuplicateIndex
+        self.duplicate_index_path = None
         self.initialize_accession_settings(settings_file)
+        self.exclusions = ExclusionMatcher(self.excludes, self.excludes_regex, self.excludes_glob)
 
         # Regular expressions for file name cleansing
         self.valid_bag_name_format = re.compile("^[0-9]{8}_[0-9]{6}_.*")
-        self.chars_to_remove = re.compile("[:'\+\=,\!\@\#\$\%\^\&\*\(\)\]\[ \t]") # non-Windows
+        # characters replaced with underscores
+        self.chars_to_remove = u":'+=,!@#$%^&*()][ \t" # non-Windows
         if sys.platform == 'win32' or platform.system() == 'Windows':
-            self.chars_to_remove = re.compile("[:/'\+\=,\!\@\#\$\%\^\&\*\(\)\]\[ \t]")
+            self.chars_to_remove = u":/'+=,!@#$%^&*()][ \t"
+        self.cleanser = NameCleanser(self.chars_to_remove)
 
         self.import_file_name, self.import_file, self.import_writer = None, None, None
         self.import_header = ["Month", "Day", "Year", "Title", "Identifier", "Inclusive Dates", 
@@ -43,66 +96,388 @@ class DataAccessioner:
         self.import_row["Location"] = self.storage_location_name
         self.import_row["Extent Unit"], self.import_row["ExtentUnit"] = "Gigabytes", "Gigabytes"
 
+        # Bags may be accessioned by several worker threads at once
+        self.new_directory_lock = threading.Lock()
+        # Replaced by ones kept on disk, in the top directory, in accession_bags_in_dir()
+        self.identifiers = BagIdentifierAllocator()
+        self.journal = AccessionJournal()
+        # Finished bags are skipped going by the journal; set to walk them again and 
+        # accession the ones that have changed, see AccessionJournal.is_finished()
+        self.recheck_finished = False
+
+        # BagIt manifests are only written if algorithms are given (e.g. ["md5", "sha256"])
+        self.manifest_algorithms = []
+        self.hash_workers = 4
+        # Counts the formats of each bag's files from their first bytes, see identify_bag_formats()
+        self.identify_formats = False
+        # Looks for copies of each bag's files in it and in earlier bags, see find_duplicates()
+        self.detect_duplicates = False
+        # bags are checked against each other one at a time, so bags accessioned at once see each other
+        self.duplicates_lock = threading.Lock()
+        # Opened by open_top_dir() when looking for duplicates
+        self.duplicate_index = None
+        # Finished bags are packaged into tar files in this folder if it is set, see package_bag()
+        self.package_dir = None
+        self.package_compression = None
+        self.compress_workers = 4
+
+        # Thread pools shared by all bags, see shared_pool()
+        self.pools, self.pools_lock = {}, threading.Lock()
+
+        # Set to a RunReport to have the stages of accessioning each bag recorded, see stage()
+        self.run_report = None
+
     def initialize_accession_settings(self, settings_file):
         """ Parses accession_settings.txt to set self.excludes, self.excludes_regex,
-        and self.storage_location_name """        
+        self.excludes_glob, self.storage_location_name and self.duplicate_index_path. 
+        EXCLUDE_REGEX may be given on several lines. """        
         with open(settings_file) as f:
             for line in f:
+                value = line.partition(':')[2].strip()
                 if line.startswith('EXCLUDES'):
-                    self.excludes = line.strip('EXCLUDES: ').strip('\n').split(', ')
+                    self.excludes = value.split(', ')
                 if line.startswith('EXCLUDE_REGEX'):
-                    self.excludes_regex = [re.compile(line.strip('EXCLUDE_REGEX: ').strip('\n'))]
+                    self.excludes_regex.append(value)
+                if line.startswith('EXCLUDE_GLOBS'):
+                    self.excludes_glob = value.split(', ')
                 if line.startswith('STORAGE_LOCATION_NAME'):
-                    self.storage_location_name = line.strip('STORAGE_LOCATION_NAME:').strip(' ').strip('\n')
+                    self.storage_location_name = value
+                if line.startswith('DUPLICATE_INDEX') and value:
+                    self.duplicate_index_path = value
 
-    def initialize_import_file(self, top_dir):
+    def initialize_import_file(self, top_dir, roll = False):
         """ If self.create_import_file is True (set to False when calling accession_bags_
-        in_dir()), an import file (for archon database) for the bags will be created. """
+        in_dir()), an import file (for archon database) for the bags will be created. 
+        If the journal already has an import file in top_dir, rows are appended to 
+        it instead; with roll, only if that file was started today. """
         if self.create_import_file:
-            self.import_file_name = r"ImportTemplate_%s%02d%02d" % (self.now.year, self.now.month, self.now.day)
+            journal_import_file = self.journal.get_setting("import_file")
+            today = r"ImportTemplate_%s%02d%02d" % (self.now.year, self.now.month, self.now.day)
+            if journal_import_file and os.path.exists(os.path.join(top_dir,journal_import_file)) and \
+                not (roll and not journal_import_file.startswith(today)):
+                self.import_file_name = os.path.join(top_dir,journal_import_file)
+                self.import_file = open(self.import_file_name,'ab')
+                self.import_writer = csv.writer(self.import_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+                return
+            self.import_file_name = today
             self.import_file_name = path_already_exists(os.path.join(top_dir,self.import_file_name + '.csv'))
-            self.import_file = open(os.path.join(top_dir,self.import_file_name),'wb')
+            self.import_file = open(self.import_file_name,'wb')
             self.import_writer = csv.writer(self.import_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
             self.import_writer.writerow(self.import_header)
+            self.journal.set_setting("import_file", os.path.basename(self.import_file_name))
 
-    def accession_bags_in_dir(self, top_dir, import_file = True):
+    def accession_bags_in_dir(self, top_dir, import_file = True, workers = 1):
         """ Begins accessioning all items (files and folders/bags) using the given 
-        directory, top_dir, and creates an import file. """
+        directory, top_dir, and creates an import file. With workers > 1, that 
+        many bags are accessioned at once by a pool of threads; the import file 
+        is still written from this thread only, one row per bag in the order of 
+        the sorted directory listing. 
+        Progress is kept in the journal in top_dir: bags accessioned by an earlier 
+        run are skipped, bags it didn't finish pick up where it stopped, and rows 
+        are appended to its import file. """
+        self.open_top_dir(top_dir, import_file)
+        print "accessioning...\n-----"
+        bag_paths = []
+        try:
+            with self.stage(None, "list"):
+                for bag in self.list_top_dir(top_dir):
+                    full_bag_path = os.path.join(top_dir,bag)
+                    if self.journal.is_finished(bag, full_bag_path, self.is_excluded, self.recheck_finished):
+                        print 'not accessioning', bag, "already accessioned \n-----"
+                    else:
+                        bag_paths.append(full_bag_path)
+            self.accession_items(bag_paths, workers)
+        finally:
+            self.close_top_dir()
+        print "done"
+
+    def open_top_dir(self, top_dir, import_file = True, roll = False):
+        """ Opens the journal, import file, identifier reservations and (with 
+        self.detect_duplicates) duplicate index of top_dir for accession_items(). """
         # If self.create_import_file is set to false, no import file will be made
         self.create_import_file = import_file
-        self.initialize_import_file(top_dir)
+        self.journal = AccessionJournal(top_dir)
+        if self.detect_duplicates:
+            if self.duplicate_index_path is not None:
+                self.duplicate_index = DuplicateIndex(self.duplicate_index_path, shared=True)
+            else:
+                self.duplicate_index = DuplicateIndex(os.path.join(top_dir, AccessionJournal.journal_file_name))
+        self.initialize_import_file(top_dir, roll)
+        self.identifiers = BagIdentifierAllocator(top_dir)
 
-        print "accessioning...\n-----"
-        # creates a list of paths to all files and folders/bags in top_dir
-        path_list = [x for x in os.listdir(ast.literal_eval("u'" + (top_dir.replace("\\", "\\\\")) + "'")) if x != self.import_file_name]
-        for bag in path_list:
+    def close_top_dir(self):
+        """ Closes what open_top_dir() opened. """
+        if self.import_file is not None:
+            self.import_file.close()
+            self.import_file = None
+        if self.duplicate_index is not None:
+            self.duplicate_index.close()
+            self.duplicate_index = None
+        self.journal.close()
+
+    def accession_items(self, bag_paths, workers = 1, keep_going = False):
+        """ Accessions the items at bag_paths, in top_dir opened by open_top_dir(), 
+        and writes their rows to the import file. With keep_going, an item that 
+        fails is printed with its error and left as far as it got, and the 
+        others are still accessioned; the paths of the failed items are 
+        returned. Otherwise the first error is raised. """
+        if self.run_report is not None:
+            self.run_report.start(len(bag_paths), workers)
+
+        accession = self.try_accession_item if keep_going else self.accession_item
+        pool = None
+        if workers > 1:
+            # bags are I/O bound, so threads overlap the waiting without pickling the accessioner
+            pool = ThreadPool(workers)
+            results = interruptible(pool.imap(accession, bag_paths))
+        else:
+            results = itertools.imap(accession, bag_paths)
+        failed = []
+        interrupted = False
+        try:
+            # imap returns results in the order of bag_paths, whichever worker finishes first
+            for full_bag_path, result in itertools.izip(bag_paths, results):
+                if result is None:
+                    failed.append(full_bag_path)
+                    if self.run_report is not None:
+                        self.run_report.bag_done()
+                    continue
+                bag, import_row = result
+                entry = self.journal.lookup(bag)
+                if import_row is not None and entry["recorded"]:
+                    # accessioned again after changing, its identifier already has a row
+                    print "not adding", bag, "to the import file again, its row is in", entry["recorded"], \
+                        "(update it there if the changes need it)"
+                elif import_row is not None:
+                    self.import_writer.writerow(import_row)
+                    self.import_file.flush()
+                    entry = self.journal.update(entry, recorded=os.path.basename(self.import_file_name))
+                self.journal.update(entry, "recorded")
+                print "accessioning complete for", bag, "\n-----"
+                if self.run_report is not None:
+                    self.run_report.bag_done()
+        except KeyboardInterrupt:
+            # the bags being worked on are left where they are, the journal has them picked up again
+            interrupted = True
+            raise
+        finally:
+            if pool is not None:
+                if interrupted:
+                    pool.terminate()
+                else:
+                    pool.close()
+                    pool.join()
+            self.close_shared_pools(interrupted)
+            fs.close(interrupted)
+        return failed
+
+    def watch_folder(self, top_dir, settle = 60, poll_interval = 10, workers = 1):
+        """ Keeps accessioning the items dropped into top_dir until interrupted. 
+        An item is accessioned once its number of files, their total size and 
+        its latest modification time have stayed the same for settle seconds, 
+        so items still being copied in are left alone; the items that settle 
+        together are accessioned as one batch. Items are checked every 
+        poll_interval seconds, and right away when FolderWatcher sees something 
+        arrive in top_dir. Rows go to a rolling import file: appended to all day, 
+        a new one started each day. An item that fails is printed and left as 
+        far as it got, under whatever name it has by then, and the others carry 
+        on; the journal has it picked up again when watching starts again. """
+        self.open_top_dir(top_dir, roll=True)
+        watcher = FolderWatcher(top_dir)
+        print "watching", top_dir, "(%s)" % ("inotify" if watcher.fd is not None else "polling"), "\n-----"
+        # names accessioned or skipped, and (state, time first seen in that state) of the others
+        done, pending = set(), {}
+        try:
+            while True:
+                now = time.time()
+                names = self.list_top_dir(top_dir, verbose=False)
+                for name in set(pending) - set(names):
+                    del pending[name]
+                for name in names:
+                    if name in done:
+                        continue
+                    full_bag_path = os.path.join(top_dir,name)
+                    if self.journal.is_finished(name, full_bag_path, self.is_excluded, self.recheck_finished):
+                        done.add(name)
+                        continue
+                    state = self.item_state(full_bag_path)
+                    if state is None:
+                        pending.pop(name, None)
+                    elif name not in pending or pending[name][0] != state:
+                        pending[name] = (state, now)
+
+                settled = [name for name in names if name in pending and now - pending[name][1] >= settle]
+                if settled:
+                    self.roll_import_file(top_dir)
+                    print "accessioning", len(settled), "settled item(s)\n-----"
+                    for name in settled:
+                        del pending[name]
+                        # an item's new name is found finished on the next pass
+                        done.add(name)
+                    failed = self.accession_items([os.path.join(top_dir,name) for name in settled], workers, keep_going=True)
+                    for full_bag_path in failed:
+                        # a bag may have been renamed before failing, it isn't tried again under its new name either
+                        entry = self.journal.lookup_original(os.path.basename(full_bag_path))
+                        if entry is not None:
+                            done.add(entry["name"])
+                        print "left", os.path.basename(full_bag_path), "as it is until watching starts again \n-----"
+                    continue
+
+                timeout = poll_interval
+                if pending:
+                    timeout = min(timeout, max(0, min(since + settle for state, since in pending.values()) - now))
+                watcher.wait(timeout)
+        finally:
+            watcher.close()
+            self.close_top_dir()
+
+    def item_state(self, item_path):
+        """ Returns the number of files and folders in item_path, their total size 
+        and the latest modification time, or None if item_path is gone. """
+        try:
+            if os.path.isdir(item_path):
+                tree = scan_tree(item_path, self.is_excluded).tree
+                return len(tree.names), sum(tree.sizes), max(tree.mtimes)
+            item_stat = fs.stat(item_path)
+            return 1, item_stat.st_size, item_stat.st_mtime
+        except (OSError, IOError):
+            return None
+
+    def roll_import_file(self, top_dir):
+        """ Starts a new import file in top_dir once the day has changed since the 
+        current one was started, and dates the rows after it that day. """
+        now = datetime.datetime.now()
+        if now.date() == self.now.date():
+            return
+        self.now = now
+        self.import_row["Month"] = self.now.month
+        self.import_row["Day"] = self.now.day
+        self.import_row["Year"] = self.now.year
+        if self.import_file is not None:
+            self.import_file.close()
+            self.import_file = None
+        self.initialize_import_file(top_dir, roll=True)
+
+    def list_top_dir(self, top_dir, verbose = True):
+        """ Returns the sorted names of the items (files and folders/bags) in 
+        top_dir to accession, leaving out excluded ones and the accessioner's own 
+        files. With verbose, the excluded ones are printed. """
+        # creates a list of paths to all files and folders/bags in top_dir, listed in 
+        # the type paths are kept in (see native_name())
+        if os.path.supports_unicode_filenames:
+            top_dir = ast.literal_eval("u'" + (top_dir.replace("\\", "\\\\")) + "'")
+        elif isinstance(top_dir, unicode):
+            top_dir = top_dir.encode(sys.getfilesystemencoding() or 'utf-8')
+        path_list = [x for x in fs.listdir(top_dir) if x != self.import_file_name]
+        items = []
+        for bag in sorted(path_list, key=decode_name):
             full_bag_path = os.path.join(top_dir,bag)
             # prevents the import file from being bagged
-            if re.sub(r'_\d+', '', full_bag_path) == re.sub(r'_\d+', '', self.import_file_name):
+            if self.import_file_name is not None and \
+                re.sub(r'_\d+', '', full_bag_path) == re.sub(r'_\d+', '', self.import_file_name):
                 continue
-            if not self.is_excluded(bag):
-                print "current bag:", bag, "\n"
-                if not os.path.isdir(full_bag_path):
-                    bag = self.accession_file(full_bag_path)
-                else:
-                    bag = self.accession_bag(full_bag_path)
-                print "accessioning complete for", bag, "\n-----"
+            if bag in (BagIdentifierAllocator.reservation_file_name, AccessionJournal.journal_file_name, \
+                DuplicateIndex.snapshot_file_name):
+                continue
+            if self.is_excluded(bag):
+                if verbose:
+                    print 'not accessioning', bag, "based on accession settings \n-----"
             else:
-                print 'not accessioning', bag, "based on accession settings \n-----"
-        print "done"
+                items.append(bag)
+        return items
+
+    def dry_run_bags_in_dir(self, top_dir, report_path):
+        """ Writes a csv report to report_path of what accessioning the items in 
+        top_dir would do, without changing anything in it: each bag renamed, the 
+        folders made and moved for the bag structure, and the files and folders 
+        renamed, in the order accession_bag() would do them. Paths are relative 
+        to top_dir. Bags the journal has as accessioned are left out; the 
+        journal is only read. """
+        if os.path.exists(os.path.join(top_dir, AccessionJournal.journal_file_name)):
+            self.journal = AccessionJournal(top_dir, read_only=True)
+        report_file = open(report_path, "wb")
+        writer = csv.writer(report_file, quoting=csv.QUOTE_ALL)
+        writer.writerow(["Item", "Step", "Path", "New_Path"])
+        for item in self.list_top_dir(top_dir):
+            if self.journal.is_finished(item, os.path.join(top_dir, item), self.is_excluded, self.recheck_finished):
+                continue
+            for step, path, new_path in self.plan_item(top_dir, item):
+                writer.writerow([bagit_path(item), step, bagit_path(path), bagit_path(new_path)])
+        report_file.close()
+        self.journal.close()
+        print "dry run report written to", report_path
+
+    def plan_item(self, top_dir, item):
+        """ Yields the steps accessioning item, a file or folder in top_dir, would 
+        take as (step, path, new path): "mkdir" (new path is empty), "move" or 
+        "rename". The bag is scanned once and the steps are worked out on the 
+        scanned tree. """
+        item_path = os.path.join(top_dir, item)
+        if os.path.isdir(item_path):
+            bag_name, bag_tree = item, scan_tree(item_path, self.is_excluded)
+        else:
+            # accession_file() puts the file in a folder of its own
+            bag_name = os.path.basename(path_already_exists(file_folder_path(item_path)))
+            yield "mkdir", bag_name, ""
+            yield "move", item, join_names(bag_name, item)
+            bag_tree = BagTree(bag_name).root()
+            bag_tree.add_file(item, os.stat(item_path))
+
+        new_name = self.formatted_bag_name(bag_name, self.identifiers.next_timestamp())[0]
+        if new_name != bag_name:
+            yield "rename", bag_name, new_name
+
+        steps = self.plan_bag_structure([node.name for node in bag_tree.children], \
+            lambda rel_path: bag_tree.find(rel_path) is not None)
+        for step in steps:
+            if step[0] == "mkdir":
+                bag_tree.make_dir(step[1])
+                yield "mkdir", join_names(new_name, step[1]), ""
+            else:
+                bag_tree.move(step[1], step[2])
+                yield "move", join_names(new_name, step[1]), join_names(new_name, step[2])
+
+        clean_name = self.cleanse_name(new_name)
+        if clean_name != new_name:
+            yield "rename", new_name, clean_name
+
+        for rel_path, new_rel_path, node, new_node_name in self.plan_renames(bag_tree):
+            yield "rename", join_names(clean_name, rel_path), join_names(clean_name, new_rel_path)
+
+    def accession_item(self, full_bag_path):
+        """ Accessions a single item of the top directory, a file or a folder. 
+        Returns the same as accession_bag(). """
+        print "current bag:", os.path.basename(full_bag_path), "\n"
+        if not os.path.isdir(full_bag_path):
+            return self.accession_file(full_bag_path)
+        return self.accession_bag(full_bag_path)
+
+    def try_accession_item(self, full_bag_path):
+        """ Same as accession_item(), but an error is printed, with its 
+        traceback, instead of raised, and None returned. """
+        try:
+            return self.accession_item(full_bag_path)
+        except Exception:
+            print "accessioning failed for", os.path.basename(full_bag_path), "\n-----"
+            traceback.print_exc()
+            return None
 
     def accession_file(self, file_path):
         """ Given the path to a file, creates a new folder (or "bag"), to hold it 
         and calls accession_bag(p) where p is the newly created bag containing the 
         file. """
-        new_directory = os.path.splitext(file_path)[0]
-        new_directory = new_directory.encode('cp850', errors='ignore')
-
-        # If new name is in use, add an index
-        new_directory = path_already_exists(new_directory)
-    
-        os.mkdir(new_directory)
-        os.rename(file_path,os.path.join(new_directory, os.path.basename(file_path)))
+        new_directory = file_folder_path(file_path)
+
+        # If new name is in use, add an index. Locked so that two files with the 
+        # same name but different extensions don't claim the same folder.
+        with self.stage(os.path.basename(file_path), "file"):
+            with self.new_directory_lock:
+                new_directory = path_already_exists(new_directory)
+                fs.mkdir(new_directory)
+            fs.rename(file_path,os.path.join(new_directory, os.path.basename(file_path)))
+            # journaled under the file's name, the item watch_folder() knows it by
+            if self.journal.lookup(os.path.basename(new_directory)) is None:
+                self.journal.begin(os.path.basename(new_directory), os.path.basename(file_path))
         file_path = new_directory
 
         return self.accession_bag(os.path.splitext(file_path)[0])
@@ -112,227 +487,653 @@ class DataAccessioner:
         1. format bag name: creates timestamp and adds it to the bag's name
         2. creates the bag structure (bag/data/: dips, meta, originals)
         3. cleanse bag name: replaces special characters
-        4. create relative bag dictionary: makes dictionary of files and paths, 
-            checks if paths need renaming
-        5. cleanse dict: renames files
-        6. write rename file
-        7. traverse bag contents: returns the size, extensions, and # of files """
-        # update self.now ONCE per bag, sleep prevents duplicate names
-        time.sleep(1)
-        self.now = datetime.datetime.now()
-        bag_path, identifier = self.format_bag_name(bag_path)
-        self.create_bag_structure(bag_path)
-
-        bag_path, bags_renamed = self.cleanse_bag_name(bag_path) # Remove special characters
-        
-        # cleanse filenames in bag, save rename.csv metadata
-        b_dict, needs_renaming = self.create_relative_bag_dict(bag_path,os.path.join(bag_path,"data","originals"),0)
-
-        if needs_renaming or bags_renamed:
-            renamed_files_list = self.cleanse_dict(os.path.join(bag_path,"data"),b_dict,0)
-            self.write_rename_file(bag_path,renamed_files_list,bags_renamed)
-        
+        4. scan tree: walks the bag once, recording names, types, sizes and mtimes
+        5. plan renames: works out the new names of files and folders in memory
+        6. apply renames: renames them deepest first, writing the rename file as 
+            it goes
+        7. find duplicates: if self.detect_duplicates is set, looks for copies of 
+            the bag's files and writes data/meta/duplicates.csv (before the 
+            manifests, which list it)
+        8. write manifests: if self.manifest_algorithms is set, hashes the files 
+            in the scanned tree and writes the BagIt manifests
+        9. traverse bag contents: returns the size, extensions, and # of files 
+            read from the scanned tree 
+        10. identify formats: if self.identify_formats is set, counts the formats 
+            of the files from their first bytes 
+        11. package: if self.package_dir is set, streams the finished bag into a 
+            (compressed) tar file there, its checksum going in the import row 
+        Each step is recorded in self.journal; steps an earlier, interrupted run 
+        finished for this bag are not repeated. 
+        Returns the bag's new name and its row for the import file (None if no 
+        import file is being made). """
+        item = os.path.basename(bag_path)
+        entry = self.journal.lookup(item)
+        if entry is None:
+            entry = self.journal.begin(item)
+
+        if self.journal.reached(entry, "named"):
+            now, identifier = entry["started"], entry["identifier"]
+        else:
+            with self.stage(item, "format"):
+                now = self.identifiers.next_timestamp()
+                bag_path, identifier = self.format_bag_name(bag_path, now)
+            entry = self.journal.update(entry, "named", name=os.path.basename(bag_path), started=now, identifier=identifier)
+
+        if not self.journal.reached(entry, "structured"):
+            with self.stage(item, "structure"):
+                self.create_bag_structure(bag_path)
+            entry = self.journal.update(entry, "structured")
+
+        if not self.journal.reached(entry, "cleansed"):
+            with self.stage(item, "cleanse"):
+                bag_path, bags_renamed = self.cleanse_bag_name(bag_path) # Remove special characters
+                # recorded right away, a run picking the bag up again finds nothing left to rename
+                if bags_renamed:
+                    self.write_rename_file(bag_path, [], bags_renamed)
+            entry = self.journal.update(entry, name=os.path.basename(bag_path))
+
+        # walk the bag ONCE, every later step reads from this tree
+        with self.stage(item, "scan"):
+            bag_tree = scan_tree(bag_path, self.is_excluded)
+
+        if not self.journal.reached(entry, "cleansed"):
+            # cleanse filenames in bag, save rename.csv metadata
+            with self.stage(item, "plan"):
+                rename_plan = self.plan_renames(bag_tree)
+            if rename_plan:
+                with self.stage(item, "rename"):
+                    renamed_files = self.apply_renames(bag_path, rename_plan)
+                    rename_file_path = self.write_rename_file(bag_path,renamed_files,[])
+                # renames.csv was written after the walk, add it to the tree
+                bag_tree.add_file(os.path.relpath(rename_file_path, bag_path), fs.stat(rename_file_path))
+            entry = self.journal.update(entry, "cleansed")
+
+        if self.detect_duplicates and not self.journal.reached(entry, "deduped"):
+            with self.stage(item, "dedupe"):
+                with self.duplicates_lock:
+                    self.find_duplicates(bag_path, bag_tree)
+            entry = self.journal.update(entry, "deduped")
+
+        if self.manifest_algorithms and not self.journal.reached(entry, "manifested"):
+            with self.stage(item, "manifest"):
+                self.write_manifests(bag_path, bag_tree)
+            entry = self.journal.update(entry, "manifested")
+
+        entry = self.journal.update(entry, "accessioned", fingerprint=tree_fingerprint(bag_tree))
+
+        package = None
+        if self.package_dir is not None:
+            with self.stage(item, "package"):
+                package = self.package_bag(bag_path, bag_tree)
+
+        new_row = None
         if self.create_import_file:
-            size, extensions, num_files = self.traverse_bag_contents(bag_path)
+            with self.stage(item, "traverse"):
+                size, extensions, num_files = self.traverse_bag_contents(bag_tree)
             bag_name = os.path.basename(bag_path)
-            self.import_row["Title"] = bag_name
-            self.import_row["Identifier"] = identifier
-            self.import_row["Received Extent"] = size
-            self.import_row["Processed Extent"] = size
-            self.import_row["Content"] = bag_name
-            self.import_row["Scope Content"] = bag_name
-            self.import_row["Extent"] = size
-            self.import_row["Physical Description"] = "Extensions include: " + "; ".join(extensions)
-
-            # Writes data to the import template
+            # copy, other bags may be filling in their own rows at the same time
+            import_row = dict(self.import_row)
+            import_row["Title"] = cp850_name(bag_name)
+            import_row["Identifier"] = identifier
+            import_row["Received Extent"] = size
+            import_row["Processed Extent"] = size
+            import_row["Content"] = cp850_name(bag_name)
+            import_row["Scope Content"] = cp850_name(bag_name)
+            import_row["Extent"] = size
+            import_row["Physical Description"] = "Extensions include: " + "; ".join(extensions)
+            if self.identify_formats:
+                with self.stage(item, "identify"):
+                    formats = self.identify_bag_formats(bag_path, bag_tree)
+                import_row["Physical Description"] += ". Formats include: " + "; ".join("%s (%d)" % (name, count) \
+                    for name, count in sorted(formats.items(), key=lambda item: (-item[1], item[0])))
+            if package is not None:
+                import_row["Comments"] = "Packaged as %s, SHA-256 %s" % package
+
+            # Row for the import template, written by accession_bags_in_dir()
             new_row = []
             for item in self.import_header:
-                new_row.append(self.import_row[item])
-            self.import_writer.writerow(new_row)
+                new_row.append(import_row[item])
 
-        return os.path.basename(bag_path)
+        return os.path.basename(bag_path), new_row
 
-    def format_bag_name(self, bag_path):
+    @contextlib.contextmanager
+    def stage(self, item, stage):
+        """ Records the code run in the with block as the given stage of 
+        accessioning item in self.run_report, if it is set. """
+        if self.run_report is None:
+            yield
+            return
+        with self.run_report.stage(item, stage):
+            yield
+
+    def format_bag_name(self, bag_path, now):
         """ Renames the bag (folder) in the format yyyyddmm_hhmmss_originalDirTitle, 
-        created from the self.now timestamp. Returns the new bag path and the 
+        created from the bag's timestamp, now. Returns the new bag path and the 
         date_created, to be used as the bag's identifier. """
         bag_name = os.path.basename(bag_path)
+        new_valid_bag_name, date_created = self.formatted_bag_name(bag_name, now)
 
-        date_created = "%s%02d%02d_%02d%02d%02d" % (self.now.year, self.now.day, \
-        self.now.month, self.now.hour, self.now.minute, self.now.second)
-
-        if self.valid_bag_name_format.search(bag_name) == None:
-            new_valid_bag_name = "%s_%s" % (date_created,bag_name)
-            os.rename(bag_path,os.path.join(os.path.dirname(bag_path),new_valid_bag_name))
+        if new_valid_bag_name != bag_name:
+            fs.rename(bag_path,os.path.join(os.path.dirname(bag_path),new_valid_bag_name))
             bag_path = os.path.join(os.path.dirname(bag_path),new_valid_bag_name)
 
         return bag_path, date_created
 
+    def formatted_bag_name(self, bag_name, now):
+        """ Returns the name format_bag_name() gives the bag called bag_name 
+        (unchanged if it's already in the format) and the date_created. """
+        date_created = "%s%02d%02d_%02d%02d%02d" % (now.year, now.day, \
+        now.month, now.hour, now.minute, now.second)
+
+        if self.valid_bag_name_format.search(bag_name) == None:
+            return "%s_%s" % (date_created,bag_name), date_created
+        return bag_name, date_created
+
     def create_bag_structure(self, bag_path):
         """ Given the bag path, creates necessary directories and moves pre-existing 
-        directories to the correct place. 
+        directories to the correct place, following plan_bag_structure(). 
         Structure: bag/data, bag/data/dips, bag/data/meta, bag/data/originals """
+        # the only paths plan_bag_structure() asks about
+        paths = ["data"] + [os.path.join("data", dir_type) for dir_type in ["dips", "meta", "originals"]]
+        found = fs.concurrently(fs.exists, [(os.path.join(bag_path, rel_path),) for rel_path in paths])
+        existing = set(rel_path for rel_path, exists in zip(paths, found) if exists)
+        steps = self.plan_bag_structure(fs.listdir(bag_path), lambda rel_path: rel_path in existing)
+
+        # steps are run together a level at a time, so bag/data is made before 
+        # anything goes in it, and bag/data/originals before the files moved there
+        depth = lambda step: step[-1].count(os.sep)
+        for level, level_steps in itertools.groupby(sorted(steps, key=depth), key=depth):
+            fs.concurrently(self.apply_structure_step, [(bag_path, step) for step in level_steps])
+
+    def apply_structure_step(self, bag_path, step):
+        """ Carries out a step from plan_bag_structure() in the bag at bag_path. """
+        if step[0] == "mkdir":
+            fs.mkdir(os.path.join(bag_path, step[1]))
+        else:
+            destination = os.path.join(bag_path, step[2])
+            if fs.exists(destination):
+                raise shutil.Error("Destination path '%s' already exists" % destination)
+            fs.move(os.path.join(bag_path, step[1]), destination)
+            count_processed(files=1)
+
+    def plan_bag_structure(self, names_in_bag, exists):
+        """ Given the names of the files and folders in a bag and exists(), which 
+        tells whether a path relative to the bag is there, returns the steps that 
+        give the bag its structure, without carrying them out: ("mkdir", path) or 
+        ("move", path, new path), paths relative to the bag. """
+        steps = []
         # files_in_bag: if folders are already created but may need to be moved
-        files_in_bag = set(os.listdir(bag_path))
-        
+        files_in_bag = set(names_in_bag)
+
         # If directory bag/data is not present, create it
-        if not os.path.exists(os.path.join(bag_path,"data")):
-            os.mkdir(os.path.join(bag_path,"data"))
+        if not exists("data"):
+            steps.append(("mkdir", "data"))
         else:
             files_in_bag.remove("data")
 
         for dir_type in ["dips", "meta", "originals"]:
+            data_dir_type = os.path.join("data", dir_type)
             # If these directories are present in bag/: bag/dips, bag/meta or bag/originals move them to bag/data/
-            if os.path.exists(os.path.join(bag_path, dir_type)):
-                shutil.move(os.path.join(bag_path, dir_type),os.path.join(bag_path, dir_type))
+            if dir_type in files_in_bag:
                 files_in_bag.remove(dir_type)
+                if not exists(data_dir_type):
+                    steps.append(("move", dir_type, data_dir_type))
+                    continue
             # If bag/data/originals, dips, or meta are not present in bag/data, create them
-            if not os.path.exists(os.path.join(bag_path, "data", dir_type)):
-                os.mkdir(os.path.join(bag_path, "data", dir_type))
+            if not exists(data_dir_type):
+                steps.append(("mkdir", data_dir_type))
 
-        # Move all other files in bag to bag/data/originals
-        for f in files_in_bag:
-            if not self.is_excluded(f):
-                shutil.move(os.path.join(bag_path,f), os.path.join(bag_path,"data","originals"))
+        # Move all other files in bag to bag/data/originals, except BagIt's tag files
+        for f in sorted(files_in_bag, key=decode_name):
+            if not self.is_excluded(f) and BAGIT_TAG_FILE.match(decode_name(f)) is None:
+                steps.append(("move", f, os.path.join("data", "originals", f)))
+        return steps
 
     def is_excluded(self, filename):
         """ Returns True if the file name corresponds with a file name in 
-        self.excludes or if the file name has any of the characters in 
-        self.excludes_regex. Both excludes and excludes_regex are defined in 
-        accession_settings.txt. Returns False otherwise. """
-        if filename in self.excludes:
-            return True
-        for pattern in self.excludes_regex:
-            # bad file name
-            if pattern.search(filename) != None:
-                return True
-        return False
+        self.excludes, matches one of the regular expressions in 
+        self.excludes_regex or one of the patterns in self.excludes_glob. All 
+        three are defined in accession_settings.txt. Returns False otherwise. """
+        return self.exclusions.matches(filename)
 
     def cleanse_bag_name(self, bag_path):
-        """ Removes special characters listed in self.chars_to_remove from the given
-        bag and replaces them with underscores. """
+        """ Removes special characters from the given bag's name using 
+        cleanse_name(). """
         replacement_path = bag_path
         bag_name = os.path.basename(bag_path)
-        replacement_name = bag_name
-
-        for match in self.chars_to_remove.finditer(bag_name):
-            replacement_name = replacement_name.replace(match.group(), "_")
-        replacement_name = replacement_name.encode('cp850', errors='ignore')
+        replacement_name = self.cleanse_name(bag_name)
 
         if replacement_name != bag_name:
             replacement_path = os.path.join(os.path.dirname(bag_path),replacement_name)
-            os.rename(bag_path, replacement_path)
+            fs.rename(bag_path, replacement_path)
 
         bags_renamed = []
         if bag_name != replacement_name:
-            bags_renamed.append(bag_name)
-            bags_renamed.append(replacement_name)
+            bags_renamed.append(decode_name(bag_name).encode('cp850', errors='replace'))
+            bags_renamed.append(cp850_name(replacement_name))
         return (replacement_path, bags_renamed)
 
-    def create_relative_bag_dict(self, walk_path,path_to_originals,depth):
-        """ Given a bag with proper hierarchical structure, returns:
-                -a dictionary with the proper relative paths for files.
-                -a boolean value for whether anything needs to be renamed. """
-        needs_renaming = False
-        sub_dict = {}
-        return_path = os.path.basename(walk_path)
-        if depth > 2:
-            return_path = os.path.relpath(walk_path, os.path.dirname(path_to_originals))
-        return_dict = {return_path:sub_dict}
-
-        dirs_list, files_list = os.walk(walk_path).next()[1], os.walk(walk_path).next()[2]
-        for name in files_list:
-            if self.chars_to_remove.search(name) != None or name.encode('cp850', errors='ignore') != name:
-                needs_renaming = True
-            if depth < 2:
-                sub_dict[name] = ""
-            else:
-                sub_dict[os.path.relpath(os.path.join(walk_path,name), os.path.dirname(path_to_originals))] = ""
-        for name in dirs_list:
-            if self.chars_to_remove.search(name) != None or name.encode('cp850', errors='ignore') != name:
-                needs_renaming = True
-            sub_sub_dict, sub_rename = self.create_relative_bag_dict(os.path.join(walk_path,name),path_to_originals,depth+1)
-            if sub_rename:
-                needs_renaming = True
-            new_key = sub_sub_dict.keys()[0]
-            sub_dict[new_key] = sub_sub_dict[new_key]
-        return return_dict, needs_renaming
-    
-    def cleanse_dict(self, path_to_data, bag_dict, depth):
-        """ Renames files (does this include folders?) as needed and returns a list 
-        of the renamed files. """
-        renamed_files_list = []
-        for item in bag_dict:
-            repl_str = item.encode('cp850', errors='ignore')
-            for match in self.chars_to_remove.finditer(item):
-                repl_str = repl_str.replace(match.group(), "_")
-
-            # Rename the file if necessary, remove the previous key in place of the new one
-            if os.path.basename(repl_str) != os.path.basename(item):
-                repl_str = path_already_exists(os.path.join(path_to_data,repl_str))
-                # Rename the file, update dictionary and renames list
-                old_name = os.path.join(path_to_data,os.path.dirname(repl_str),os.path.basename(item))
-                os.rename(old_name, os.path.join(path_to_data,repl_str))
-                bag_dict[repl_str] = bag_dict[item]
-                renamed_files_list.append(list((os.path.basename(item.encode('cp850', errors='replace')), os.path.basename(repl_str))))
-                del bag_dict[item]
-
-            # renames all subdirectories and files
-            if repl_str in bag_dict:
-                if bag_dict[repl_str] != "":
-                    renamed_files_list = renamed_files_list + (self.cleanse_dict(path_to_data,bag_dict[repl_str], depth+1))
-        return renamed_files_list
+    def cleanse_name(self, name):
+        """ Returns name with the characters in SPECIAL_CHARACTERS deleted, the 
+        characters listed in self.chars_to_remove replaced with underscores, and 
+        anything that can't be encoded as cp850 dropped, using self.cleanser. """
+        return self.cleanser.cleanse(name)
+
+    def plan_renames(self, bag_tree):
+        """ Works out the new name of every file and folder in the scanned 
+        bag_tree that needs cleansing, in memory. Each folder's names are kept in 
+        an index, so a cleansed name that is already taken gets the next free 
+        index (_1, _2, ...) without asking the disk. Returns a list of 
+        (path, new path, node, new name), paths relative to the bag, deepest 
+        first, so that applying it in order renames the contents of a folder 
+        while the folder still has its old name; path uses the names from before 
+        any renames, new path the names after all of them. """
+        plan = []
+        stack = [(0, "", "", bag_tree)]
+        while stack:
+            depth, dir_path, new_dir_path, dir_node = stack.pop()
+            # every name in the folder is taken, renamed ones keep theirs until applied
+            children = dir_node.children
+            names_taken = set(name_key(node.name) for node in children)
+            next_index = {}
+            # the whole listing is cleansed at once
+            cleansed_names = self.cleanser.cleanse_names([node.name for node in children])
+            # sorted, so clashing names get the same index whatever order the folder lists in
+            for node, new_name in sorted(zip(children, cleansed_names), key=lambda item: decode_name(item[0].name)):
+                if node.pruned or self.is_excluded(node.name):
+                    # excluded files and folders are left as they are
+                    continue
+                if new_name != node.name:
+                    new_name = free_name(new_name, node.is_dir, names_taken, next_index)
+                    names_taken.add(name_key(new_name))
+                    plan.append((depth, os.path.join(dir_path, node.name), \
+                        os.path.join(new_dir_path, new_name), node, new_name))
+                if node.is_dir:
+                    stack.append((depth + 1, os.path.join(dir_path, node.name), \
+                        os.path.join(new_dir_path, new_name), node))
+        plan.sort(key=lambda step: -step[0])
+        return [step[1:] for step in plan]
+
+    def apply_renames(self, bag_path, rename_plan):
+        """ Renames the files and folders in the bag at bag_path following 
+        rename_plan, from plan_renames(), in one pass, and keeps the tree's names 
+        up to date. Yields [old name, new name] for each rename done, for 
+        write_rename_file(). 
+        The renames of a level of the tree don't depend on each other (clashes 
+        were resolved by the plan), so each level is renamed at once through 
+        fs.concurrently(), deepest first: a folder's contents are renamed while 
+        it still has the name the plan's paths use. """
+        for level, steps in itertools.groupby(rename_plan, key=lambda step: step[0].count(os.sep)):
+            steps = list(steps)
+            results = fs.concurrently(self.apply_rename_step, [(os.path.join(bag_path, rel_path), \
+                os.path.join(bag_path, os.path.dirname(rel_path), new_name)) \
+                for rel_path, new_rel_path, node, new_name in steps], errors=True)
+            # renames that went through are recorded before raising the first that didn't
+            for (rel_path, new_rel_path, node, new_name), error in zip(steps, results):
+                if error is None:
+                    count_processed(files=1)
+                    yield [decode_name(node.name).encode('cp850', errors='replace'), cp850_name(new_name)]
+                    node.name = new_name
+            for error in results:
+                if error is not None:
+                    raise error
+
+    def apply_rename_step(self, path, new_path):
+        """ Renames path to new_path for apply_renames(), never replacing what is 
+        already at new_path (on case-insensitive storage, a name that differs 
+        from new_path only in case). """
+        if fs.exists(new_path):
+            raise OSError("Destination path '%s' already exists" % new_path)
+        fs.rename(path, new_path)
 
     def write_rename_file(self, bag_path, files_to_rename, bags_renamed):
         """ Writes a csv file with the files and folders that have been renamed, 
-        allowing us to go back to this file and browse the original names. """
+        allowing us to go back to this file and browse the original names. 
+        files_to_rename may be a generator, rows are written as they come. 
+        Rows are dated with the time the renames are made, not the bag's 
+        identifier, which can run ahead of it (see BagIdentifierAllocator). 
+        Returns the path to the csv file. """
+        now = datetime.datetime.now()
         rename_file_path = os.path.join(bag_path,"data","meta","renames")
 
-        if os.path.exists(rename_file_path + ".csv"):
-            out_file = open(rename_file_path + ".csv", "ab")
+        if fs.exists(rename_file_path + ".csv"):
+            unshare_file(rename_file_path + ".csv")
+            out_file = fs.open(rename_file_path + ".csv", "ab")
             writer = csv.writer(out_file, quoting=csv.QUOTE_ALL)
         else:
-            out_file = open(rename_file_path + ".csv", "wb")
+            out_file = fs.open(rename_file_path + ".csv", "wb")
             writer = csv.writer(out_file, quoting=csv.QUOTE_ALL)
             writer.writerow(["Old_Name", "New_Name", "Date Renamed"])
 
         if len(bags_renamed) == 2:
-            bags_renamed.append(str(self.now))
+            bags_renamed.append(str(now))
             writer.writerow(bags_renamed)
 
         for row in files_to_rename:
             row[0], row[1] = os.path.basename(row[0]), os.path.basename(row[1])
-            row.append(str(self.now))
+            row.append(str(now))
             writer.writerow(row)
+            out_file.flush()
 
         out_file.close()
+        return rename_file_path + ".csv"
+
+    def write_manifests(self, bag_path, bag_tree):
+        """ For each algorithm in self.manifest_algorithms, writes the BagIt 
+        manifest-<alg>.txt for the payload (everything in bag/data) and 
+        tagmanifest-<alg>.txt for the tag files, adding bagit.txt if the bag 
+        doesn't have one yet. Payload files are taken from the scanned tree and 
+        read once each, in chunks, with every algorithm updated from the same 
+        read; self.hash_workers threads hash files at once. A symlink to a file 
+        is listed with the hash of the file's contents, as BagIt validators read 
+        it; symlinks to folders and broken symlinks can't be, and are left out 
+        of the manifest with a warning. Prints the hashing throughput. """
+        start = time.time()
+        payload = list(bag_tree.child("data").iter_files("data"))
+        # folders pruned from the walk are still payload, and BagIt needs every payload file listed
+        for rel_path, node in bag_tree.child("data").walk("data"):
+            if node.pruned:
+                payload.extend(scan_tree(os.path.join(bag_path, rel_path)).iter_files(rel_path))
+        payload.sort(key=lambda item: decode_name(item[0]))
+        unlisted = set(rel_path for rel_path, node in payload \
+                       if node.is_link and not fs.isfile(os.path.join(bag_path, rel_path)))
+        for rel_path in sorted(unlisted, key=decode_name):
+            print "manifest: left out %s, a symlink to a folder or to nothing" % decode_name(rel_path)
+        payload = [(rel_path, node) for rel_path, node in payload if rel_path not in unlisted]
+        payload_paths = [os.path.join(bag_path, rel_path) for rel_path, node in payload]
+
+        # imap keeps the digests in the (sorted) order of payload
+        digests = self.shared_pool("hash", self.hash_workers).imap(lambda path: \
+            hash_file(path, self.manifest_algorithms), payload_paths)
+        manifest_lines = {alg:[] for alg in self.manifest_algorithms}
+        for (rel_path, node), file_digests in itertools.izip(payload, digests):
+            for alg in self.manifest_algorithms:
+                manifest_lines[alg].append("%s  %s\n" % (file_digests[alg], bagit_path(rel_path)))
 
-    def traverse_bag_contents(self, bag_path):
-        """ Returns the size, extensions, and the number of files. num_files is not 
-        currently in use. """
+        elapsed = time.time() - start
+        payload_bytes = sum(fs.stat(path).st_size if node.is_link else node.size \
+                            for path, (rel_path, node) in itertools.izip(payload_paths, payload))
+        count_call("open", len(payload))
+        count_processed(files=len(payload), size=payload_bytes)
+        print "manifest: hashed %d files, %.1f MB in %.2f s (%.1f MB/s)" % (len(payload), \
+        payload_bytes / 1048576.0, elapsed, payload_bytes / 1048576.0 / max(elapsed, 0.001))
+
+        tag_files = []
+        if bag_tree.child("bagit.txt") is None:
+            with fs.open(os.path.join(bag_path, "bagit.txt"), "wb") as f:
+                f.write("BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n")
+        tag_files.append("bagit.txt")
+        if bag_tree.child("bag-info.txt") is not None:
+            tag_files.append("bag-info.txt")
+        for alg in self.manifest_algorithms:
+            unshare_file(os.path.join(bag_path, "manifest-%s.txt" % alg))
+            with fs.open(os.path.join(bag_path, "manifest-%s.txt" % alg), "wb") as f:
+                f.writelines(manifest_lines[alg])
+            tag_files.append("manifest-%s.txt" % alg)
+
+        # tag manifests don't list each other
+        for alg in self.manifest_algorithms:
+            unshare_file(os.path.join(bag_path, "tagmanifest-%s.txt" % alg))
+            with fs.open(os.path.join(bag_path, "tagmanifest-%s.txt" % alg), "wb") as f:
+                for tag_file in tag_files:
+                    f.write("%s  %s\n" % (hash_file(os.path.join(bag_path, tag_file), [alg])[alg], tag_file))
+
+        # the tag files were written after the walk, add them to the tree
+        for tag_file in tag_files + ["tagmanifest-%s.txt" % alg for alg in self.manifest_algorithms]:
+            bag_tree.add_file(tag_file, fs.stat(os.path.join(bag_path, tag_file)))
+
+    def shared_pool(self, name, size):
+        """ Returns the pool of size threads called name, shared by every bag, 
+        starting it on first use. Pools are closed by close_shared_pools(). """
+        with self.pools_lock:
+            if name not in self.pools:
+                self.pools[name] = ThreadPool(size)
+            return self.pools[name]
+
+    def close_shared_pools(self, terminate=False):
+        """ Waits for and closes the pools started by shared_pool(), or with 
+        terminate, stops them without waiting. """
+        with self.pools_lock:
+            for pool in self.pools.values():
+                if terminate:
+                    pool.terminate()
+                else:
+                    pool.close()
+                    pool.join()
+            self.pools = {}
+
+    def traverse_bag_contents(self, bag_tree):
+        """ Given the scanned tree of a bag, returns the size, extensions, and the 
+        number of files. num_files is not currently in use. """
         total_size = 0
         file_types = set()
         num_files = 0
-        # List of everything contained in the "originals" folder (the primary bag data we're concerned with)
-        dirs_in_originals_folder = os.listdir(os.path.join(bag_path, "data", "originals"))
-
-        for root, dirs, files in os.walk(ast.literal_eval("u'" + (bag_path.replace("\\", "\\\\")) + "'"), topdown=False):
-            if os.path.basename(root) == "originals":
-                num_files += len(files) + len(dirs)
-            elif os.path.basename(root) in dirs_in_originals_folder:
-                dirs_in_originals_folder = dirs_in_originals_folder + os.listdir(root)
-                # in case a directory after we've traversed originals has the same name as a directory in originals
-                dirs_in_originals_folder.remove(os.path.basename(root))
-                num_files+=len(files) + len(dirs)
-            for names in files:
-                filepath = os.path.join(root,names)
-                if not self.is_excluded(names):
-                    total_size += os.path.getsize(filepath)
-                    if not os.path.splitext(filepath)[1] == "":
-                        file_types.add(os.path.splitext(filepath)[1])
+
+        # stack of (node, whether the node is inside the "originals" folder)
+        stack = [(bag_tree, False)]
+        while stack:
+            dir_node, in_originals = stack.pop()
+            for node in dir_node.iter_children():
+                # everything contained in the "originals" folder (the primary bag data we're concerned with)
+                if in_originals:
+                    num_files += 1
+                if node.is_dir:
+                    stack.append((node, in_originals or (node.name == "originals" and dir_node.name == "data")))
+                elif not self.is_excluded(node.name):
+                    total_size += node.size
+                    count_processed(files=1, size=node.size)
+                    if not os.path.splitext(node.name)[1] == "":
+                        file_types.add(os.path.splitext(node.name)[1])
 
         return self.convert_size_to_string(total_size), file_types, num_files
 
+    def identify_bag_formats(self, bag_path, bag_tree):
+        """ Returns the number of files in the bag's data folder of each format, 
+        identified by identify_format() from the first FORMAT_HEAD_SIZE bytes of 
+        each file (see payload_files()). Files are taken from the scanned 
+        tree FORMAT_BATCH_SIZE at a time, as it's walked, and their heads read 
+        through fs.concurrently(). Formats are cached in the journal by inode, mtime and 
+        size, so files identified by an earlier run aren't read again. Symlinks 
+        aren't followed, they're counted as "Symbolic link". """
+        files = self.payload_files(bag_tree)
+        formats = {}
+        while True:
+            batch = list(itertools.islice(files, FORMAT_BATCH_SIZE))
+            if not batch:
+                break
+            keys = [(int(node.inode), node.mtime, int(node.size)) for rel_path, node in batch]
+            links = set(i for i, (rel_path, node) in enumerate(batch) if node.is_link)
+            cached = self.journal.cached_formats(keys, FORMAT_SIGNATURES_VERSION)
+            # without inodes (Windows, Python 2) there is nothing to cache by
+            unread = [i for i, key in enumerate(keys) if i not in links and (key[0] == 0 or key not in cached)]
+            heads = fs.concurrently(read_head, [(os.path.join(bag_path, batch[i][0]),) for i in unread], errors=True)
+            # by position in the batch: files without inodes may share a key
+            identified = {}
+            for i, head in itertools.izip(unread, heads):
+                identified[i] = "Unreadable" if isinstance(head, EnvironmentError) else identify_format(head)
+            count_processed(files=len(unread), size=sum(len(head) for head in heads if isinstance(head, str)))
+            self.journal.cache_formats([(keys[i], name) for i, name in identified.items() if keys[i][0] != 0], \
+                FORMAT_SIGNATURES_VERSION)
+            for i, key in enumerate(keys):
+                name = "Symbolic link" if i in links else identified[i] if i in identified else cached[key]
+                formats[name] = formats.get(name, 0) + 1
+        return formats
+
+    def payload_files(self, bag_tree):
+        """ Yields (rel_path, node) for the files in the bag's data folder, leaving 
+        out excluded ones and the files the accessioner writes there. """
+        for rel_path, node in bag_tree.child("data").iter_files("data"):
+            if rel_path not in ACCESSIONER_FILES and not self.is_excluded(node.name):
+                yield rel_path, node
+
+    def find_duplicates(self, bag_path, bag_tree):
+        """ Looks for copies of the bag's files (see payload_files(), empty ones 
+        and symlinks left out), in the bag and in the bags indexed in 
+        self.duplicate_index by earlier calls, in tiers so that few files are read whole: 
+        1. files are grouped by size, a file with a size of its own has no copy 
+        2. files sharing a size are compared by quick_hash(), which reads their 
+            first and last DUPLICATE_BLOCK_SIZE bytes 
+        3. files that still collide are hashed whole (SHA-256) 
+        Hashes of indexed files are kept in the index; one that is missing is 
+        worked out from the file, if it is still where it was indexed. The bag's 
+        files are then indexed, and its files that have copies listed in 
+        data/meta/duplicates.csv, each with the first of its copies (its bag 
+        given as a path if it's in another top directory). 
+        Names are kept as bytes, as on disk (see name_bytes()), so files can be 
+        found again and are listed like renames.csv lists them. 
+        Returns the number of the bag's files that have copies. """
+        top_dir, bag_name = os.path.split(bag_path)
+        # a bag accessioned again is checked afresh, not against itself
+        self.duplicate_index.unindex_bag(top_dir, bag_name)
+        files = [{"id": None, "bag": name_bytes(bag_name), "path": name_bytes(rel_path), "size": int(node.size), \
+            "quick": None, "digest": None, "file": os.path.join(bag_path, rel_path)} \
+            for rel_path, node in self.payload_files(bag_tree) if node.size > 0 and not node.is_link]
+        indexed = self.duplicate_index.indexed_files(set(f["size"] for f in files))
+
+        same_size = group_by(files + indexed, lambda f: f["size"])
+        candidates = [f for group in same_size.values() if len(group) > 1 for f in group]
+        self.hash_files(top_dir, [f for f in candidates if f["quick"] is None], "quick")
+
+        same_quick = group_by([f for f in candidates if f["quick"] is not None], lambda f: (f["size"], f["quick"]))
+        candidates = [f for group in same_quick.values() if len(group) > 1 for f in group]
+        self.hash_files(top_dir, [f for f in candidates if f["digest"] is None], "digest")
+
+        same_digest = group_by([f for f in candidates if f["digest"] is not None], lambda f: f["digest"])
+        self.duplicate_index.update_indexed([f for f in indexed if f.get("hashed")])
+        self.duplicate_index.index_files(top_dir, files)
+        own_top_dir = name_bytes(os.path.abspath(top_dir))
+
+        rows = []
+        for group in same_digest.values():
+            if len(group) < 2:
+                continue
+            # files of earlier bags first, then the bag's own; a file's first copy is the first other one
+            group.sort(key=lambda f: (f["id"] is None, f["bag"], f["path"]))
+            for f in group:
+                if f["id"] is None:
+                    first = group[1] if f is group[0] else group[0]
+                    first_bag = first["bag"]
+                    if first.get("top_dir") not in (None, own_top_dir):
+                        first_bag = os.path.join(first["top_dir"], first_bag)
+                    rows.append([f["path"], f["size"], f["digest"], len(group) - 1, first_bag, first["path"]])
+        if rows:
+            duplicates_path = os.path.join(bag_path, "data", "meta", "duplicates.csv")
+            unshare_file(duplicates_path)
+            with fs.open(duplicates_path, "wb") as out_file:
+                writer = csv.writer(out_file, quoting=csv.QUOTE_ALL)
+                writer.writerow(["Path", "Size", "SHA256", "Copies", "Copy_Bag", "Copy_Path"])
+                for row in sorted(rows):
+                    writer.writerow(row)
+            # written after the walk, add it to the tree
+            bag_tree.add_file(os.path.join("data", "meta", "duplicates.csv"), fs.stat(duplicates_path))
+        print "duplicates: %d of %d files have copies, %.1f MB" % (len(rows), len(files), \
+            sum(row[1] for row in rows) / 1048576.0)
+        return len(rows)
+
+    def hash_files(self, top_dir, files, tier):
+        """ Sets the "quick" hashes (see quick_hash()), or the SHA-256 "digest"s, 
+        of files (dictionaries from find_duplicates()), reading them from their 
+        bags, in top_dir unless indexed with another. Quick hashes are read through fs.concurrently(), whole 
+        files hashed by self.hash_workers threads. A file that can't be read is 
+        left without; the others are marked "hashed". """
+        paths = [f["file"] if "file" in f else index_path(f["top_dir"] or top_dir, f["bag"], f["path"]) for f in files]
+        if tier == "quick":
+            results = fs.concurrently(quick_hash, [(path, f["size"]) for path, f in itertools.izip(paths, files)], errors=True)
+        else:
+            def full_hash(path):
+                try:
+                    return hash_file(path, ["sha256"])["sha256"]
+                except EnvironmentError as error:
+                    return error
+            results = self.shared_pool("hash", self.hash_workers).map(full_hash, paths)
+            count_call("open", len(paths))
+        read = 0
+        for f, result in itertools.izip(files, results):
+            if isinstance(result, EnvironmentError):
+                continue
+            f["hashed"] = True
+            if tier == "quick":
+                f["quick"], digest = result
+                # a file no longer than two blocks has been read whole
+                f["digest"] = f["digest"] or digest
+                read += min(f["size"], 2 * DUPLICATE_BLOCK_SIZE)
+            else:
+                f["digest"] = result
+                read += f["size"]
+        # files are counted once, in the first tier they're read in
+        count_processed(files=len(files) if tier == "quick" else 0, size=read)
+
+    def package_bag(self, bag_path, bag_tree):
+        """ Streams the finished bag into a tar file in self.package_dir, named 
+        after the bag and compressed with self.package_compression (None, "gzip" 
+        or "zstd"), as a pipeline whose stages run at once: 
+        1. this thread puts the tar stream together from the scanned tree (see 
+            package_entries()), reading each file once, and cuts it into 
+            PACKAGE_BLOCK_SIZE blocks 
+        2. self.compress_workers threads compress the blocks, each on its own 
+            (gzip members or zstd frames, which decompress as one stream); no 
+            more than two blocks per thread are held at once 
+        3. an ArchiveSink writes the blocks, in order, in one thread and hashes 
+            them (SHA-256) in another 
+        The tar file is written under a temporary name and renamed once it's 
+        complete. Returns its name and checksum. """
+        start = time.time()
+        bag_name = name_bytes(os.path.basename(bag_path))
+        archive_name = bag_name + ".tar" + {"gzip": ".gz", "zstd": ".zst"}.get(self.package_compression, "")
+        archive_path = os.path.join(name_bytes(self.package_dir), archive_name)
+        compress = {"gzip": gzip_member, "zstd": zstd_frame}.get(self.package_compression)
+        pool = self.shared_pool("compress", self.compress_workers) if compress is not None else None
+
+        sink = ArchiveSink(archive_path + ".part")
+        files, read = 0, 0
+        try:
+            pending = collections.deque()
+            for block, block_files, block_read in tar_blocks(self.package_entries(bag_path, bag_tree)):
+                files, read = files + block_files, read + block_read
+                pending.append(pool.apply_async(compress, (block,)) if pool is not None else block)
+                if len(pending) > 2 * self.compress_workers:
+                    block = pending.popleft()
+                    sink.put(block.get() if pool is not None else block)
+            while pending:
+                block = pending.popleft()
+                sink.put(block.get() if pool is not None else block)
+        except:
+            error = sys.exc_info()
+            try:
+                sink.close()
+            except EnvironmentError:
+                pass
+            os.remove(archive_path + ".part")
+            raise error[0], error[1], error[2]
+        checksum = sink.close()
+        if fs.exists(archive_path):
+            os.remove(archive_path)
+        fs.rename(archive_path + ".part", archive_path)
+
+        elapsed = time.time() - start
+        count_processed(files=files, size=read)
+        print "package: wrote %s, %.1f MB from %.1f MB in %.2f s (%.1f MB/s)" % (archive_name, sink.size / 1048576.0, \
+            read / 1048576.0, elapsed, read / 1048576.0 / max(elapsed, 0.001))
+        return archive_name, checksum
+
+    def package_entries(self, bag_path, bag_tree):
+        """ Yields (arcname, path, type, size, mtime) for the bag's folder and 
+        everything in it, parents before their contents, from the scanned tree; 
+        type is the tarfile type of the entry, a folder, file or symlink. 
+        Folders pruned from the scan are scanned now, their contents belong in 
+        the package (and are listed in the manifests). """
+        bag_name = name_bytes(os.path.basename(bag_path))
+        yield bag_name, bag_path, tarfile.DIRTYPE, 0, fs.stat(bag_path).st_mtime
+        walks = [bag_tree.walk("")]
+        while walks:
+            for rel_path, node in walks.pop():
+                path = os.path.join(bag_path, rel_path)
+                entry_type = tarfile.SYMTYPE if node.is_link else tarfile.DIRTYPE if node.is_dir else tarfile.REGTYPE
+                yield bag_name + "/" + name_bytes(rel_path).replace(os.sep, "/"), path, entry_type, \
+                    int(node.size), node.mtime
+                if node.pruned:
+                    walks.append(scan_tree(path).walk(rel_path))
+
     def convert_size_to_string(self, size):
         """ If size < 0.01, return 0.01. Otherwise convert size into a truncated string. """
         conversion = 9.31323e-10
@@ -342,63 +1143,1330 @@ class DataAccessioner:
             file_size_string = "0.01"    
         return file_size_string
 
-def rec_traverse_dir(curr_dir, root):
-    """ Recursive function to traverse the current directory. Used in 
-    conjunction with remove_special_characters() to remove all invalid values 
-    from all subdirectories and their files. See http://stackoverflow.com/a/13528334/3889452"""
-    try :
-        dfList = [os.path.join(curr_dir, f_or_d) for f_or_d in os.listdir(curr_dir)]
-    except:
-        print "wrong path name/directory name"
-        return
+class BagIdentifierAllocator:
+    """ Hands out the timestamps bags are named and identified by 
+    (yyyyddmm_hhmmss). Identifiers are to the second, so each new timestamp is 
+    the current time or, if that second is already taken, one second after the 
+    last timestamp handed out; when bags are named faster than one a second, 
+    their identifiers run ahead of the clock (even into the next day). Given a top directory, the last timestamp is also 
+    reserved in a file there, under a file lock, so concurrent runs on the same 
+    directory never hand out the same identifier either. """
+    reservation_file_name = ".bag_identifiers"
+
+    def __init__(self, top_dir=None):
+        self.lock = threading.Lock()
+        self.last = None
+        self.reservation_file_path = None
+        if top_dir is not None:
+            self.reservation_file_path = os.path.join(top_dir, self.reservation_file_name)
+
+    def next_timestamp(self):
+        """ Returns a timestamp later (to the second) than any handed out before. """
+        with self.lock:
+            if self.reservation_file_path is None:
+                self.last = self.after_last(self.last)
+                return self.last
+            with open(self.reservation_file_path, "a+") as f:
+                lock_file(f)
+                try:
+                    f.seek(0)
+                    reserved = f.read().strip()
+                    last = self.last
+                    if reserved:
+                        reserved = datetime.datetime.strptime(reserved, "%Y-%m-%d %H:%M:%S")
+                        if last is None or reserved > last:
+                            last = reserved
+                    self.last = self.after_last(last)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(self.last.strftime("%Y-%m-%d %H:%M:%S"))
+                    f.flush()
+                finally:
+                    unlock_file(f)
+            return self.last
+
+    def after_last(self, last):
+        """ Returns the current time to the second, or one second after last if 
+        the current time isn't later than last. """
+        now = datetime.datetime.now().replace(microsecond=0)
+        if last is not None and now <= last:
+            now = last + datetime.timedelta(seconds=1)
+        return now
+
+def interruptible(results, timeout=0.5):
+    """ Yields the results of a pool's imap(), waiting for each timeout seconds 
+    at a time: Python 2 doesn't deliver KeyboardInterrupt (Ctrl-C) to a thread 
+    waiting without a timeout. """
+    while True:
+        try:
+            yield results.next(timeout)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+def lock_file(f):
+    """ Blocks until this process holds an exclusive lock on the open file f. """
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except IOError:
+                # LK_LOCK gives up after 10 seconds
+                pass
+
+def unlock_file(f):
+    """ Releases the lock taken by lock_file(). """
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class AccessionJournal:
+    """ Records how far each bag in a top directory has got through 
+    accession_bag(), in an SQLite database in that directory, so that an 
+    interrupted run can be picked up again. Bags are looked up by their current 
+    name in the top directory. Once a bag is finished, a fingerprint of its 
+    whole tree is kept, so later runs asked to recheck finished bags can tell 
+    whether one has changed since. Without a top directory the journal is kept 
+    in memory only; read_only ones are never written to. """
+    journal_file_name = ".accession_journal.sqlite"
+    # in order; "deduped" and "manifested" are skipped when duplicates aren't looked for 
+    # and no manifests are written
+    stages = ["named", "structured", "cleansed", "deduped", "manifested", "accessioned", "recorded"]
+
+    def __init__(self, top_dir=None, read_only=False):
+        journal_path = ":memory:"
+        if top_dir is not None:
+            journal_path = os.path.join(top_dir, self.journal_file_name)
+        self.read_only = read_only
+        # shared by the worker threads, which take turns using self.lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        if read_only:
+            return
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS bags (id INTEGER PRIMARY KEY, "
+                "name TEXT UNIQUE, original_name TEXT, started TEXT, identifier TEXT, stage TEXT, "
+                "fingerprint TEXT, recorded TEXT, updated TEXT)")
+            # the import file a bag's row was written to, added after the table was; bags 
+            # recorded before then have a row in a file that wasn't noted down
+            if "recorded" not in [row["name"] for row in self.connection.execute("PRAGMA table_info(bags)")]:
+                self.connection.execute("ALTER TABLE bags ADD COLUMN recorded TEXT")
+                self.connection.execute("UPDATE bags SET recorded = 'an earlier import file' WHERE stage = 'recorded'")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS formats (inode INTEGER, mtime REAL, "
+                "size INTEGER, version INTEGER, format TEXT, PRIMARY KEY (inode, mtime, size))")
+
+    def lookup(self, name):
+        """ Returns the journal entry (a dictionary) of the bag called name, or None. """
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM bags WHERE name = ?", (decode_name(name),)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        if entry["started"] is not None:
+            entry["started"] = datetime.datetime.strptime(entry["started"], "%Y-%m-%d %H:%M:%S")
+        return entry
+
+    def lookup_original(self, name):
+        """ Returns the journal entry of the latest bag first called name, or None. """
+        with self.lock:
+            row = self.connection.execute("SELECT name FROM bags WHERE original_name = ? ORDER BY id DESC LIMIT 1", \
+                (decode_name(name),)).fetchone()
+        return self.lookup(row["name"]) if row is not None else None
+
+    def begin(self, name, original_name=None):
+        """ Adds the bag called name to the journal and returns its entry. 
+        original_name is the name of the item in the top directory it was made 
+        from, if not name (a loose file is put in a folder of its own). """
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT INTO bags (name, original_name, updated) VALUES (?, ?, ?)", \
+                    (decode_name(name), decode_name(original_name or name), str(datetime.datetime.now())))
+        return self.lookup(name)
+
+    def update(self, entry, stage=None, **fields):
+        """ Records that the bag of entry has finished stage (if given) and sets 
+        any other fields given. Returns the updated entry. """
+        if stage is not None:
+            fields["stage"] = stage
+        if "name" in fields:
+            fields["name"] = decode_name(fields["name"])
+        if "started" in fields:
+            fields["started"] = fields["started"].strftime("%Y-%m-%d %H:%M:%S")
+        fields["updated"] = str(datetime.datetime.now())
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE bags SET %s WHERE id = ?" % ", ".join("%s = ?" % key for key in fields), \
+                    fields.values() + [entry["id"]])
+            row = self.connection.execute("SELECT name FROM bags WHERE id = ?", (entry["id"],)).fetchone()
+        return self.lookup(row["name"])
+
+    def reached(self, entry, stage):
+        """ Returns True if the bag of entry has finished stage. """
+        return entry["stage"] is not None and self.stages.index(entry["stage"]) >= self.stages.index(stage)
+
+    def is_finished(self, name, bag_path, prune=None, recheck=False):
+        """ Returns True if the bag called name, at bag_path, was accessioned by 
+        an earlier run, going by the journal alone. With recheck, the bag must 
+        also not have changed since: it is walked (pruning folders like 
+        scan_tree()) and its fingerprint compared, as a change anywhere below 
+        its folder leaves the folder itself as it was, and a bag that has 
+        changed is set back to be accessioned again, keeping its identifier. """
+        entry = self.lookup(name)
+        if entry is None or not self.reached(entry, "recorded"):
+            return False
+        if not recheck:
+            return True
+        if os.path.isdir(bag_path) and entry["fingerprint"] == tree_fingerprint(scan_tree(bag_path, prune)):
+            return True
+        if not self.read_only:
+            self.update(entry, "named")
+        return False
+
+    def get_setting(self, key):
+        """ Returns the value saved for key by set_setting(), or None. """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row is not None else None
+
+    def set_setting(self, key, value):
+        """ Saves value under key. """
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, decode_name(value)))
+
+    def cached_formats(self, keys, version):
+        """ Returns a dictionary of (inode, mtime, size) to format for those of 
+        keys cached by cache_formats() with the same version. """
+        inodes = sorted(set(inode for inode, mtime, size in keys))
+        formats = {}
+        with self.lock:
+            # a few hundred at a time, SQLite limits the parameters of a statement
+            for start in range(0, len(inodes), 500):
+                chunk = inodes[start:start + 500]
+                for row in self.connection.execute("SELECT * FROM formats WHERE version = ? AND inode IN (%s)" \
+                    % ", ".join("?" * len(chunk)), [version] + chunk):
+                    formats[(row["inode"], row["mtime"], row["size"])] = row["format"]
+        return formats
+
+    def cache_formats(self, formats, version):
+        """ Saves ((inode, mtime, size), format) pairs, identified with the 
+        signatures of version. """
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO formats (inode, mtime, size, version, format) "
+                    "VALUES (?, ?, ?, ?, ?)", [key + (version, name) for key, name in formats])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class DuplicateIndex:
+    """ The files find_duplicates() has seen, with whatever hashes were worked 
+    out for them, in an SQLite database: the journal of the top directory, 
+    unless a shared index is set (DUPLICATE_INDEX in accession_settings.txt, or 
+    --dedupe-index), so that bags are also checked against the ones of other 
+    top directories. A shared index keeps each file with the absolute path of 
+    its top directory, so it can be read again from any other; the journal's 
+    leaves it out, so the top directory can be moved. """
+    # the name of the copy of a shared index in a debug snapshot
+    snapshot_file_name = ".duplicate_index.sqlite"
+
+    def __init__(self, index_path, shared=False):
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            # names as BLOBs, hashes left NULL until needed
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, bag BLOB, "
+                "path BLOB, size INTEGER, quick TEXT, digest TEXT, top_dir BLOB)")
+            # added after the table was
+            if "top_dir" not in [row["name"] for row in self.connection.execute("PRAGMA table_info(files)")]:
+                self.connection.execute("ALTER TABLE files ADD COLUMN top_dir BLOB")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+
+    def indexed_files(self, sizes):
+        """ Returns the indexed files of any of sizes, as dictionaries of id, 
+        top_dir (None in the journal's index), bag, path (names as bytes, see 
+        name_bytes()), size, quick and digest. """
+        sizes = sorted(sizes)
+        files = []
+        with self.lock:
+            for start in range(0, len(sizes), 500):
+                chunk = sizes[start:start + 500]
+                for row in self.connection.execute("SELECT * FROM files WHERE size IN (%s)" \
+                    % ", ".join("?" * len(chunk)), chunk):
+                    f = dict(row)
+                    f["bag"], f["path"] = str(f["bag"]), str(f["path"])
+                    if f["top_dir"] is not None:
+                        f["top_dir"] = str(f["top_dir"])
+                    files.append(f)
+        return files
+
+    def index_files(self, top_dir, files):
+        """ Adds files, dictionaries like the ones indexed_files() returns, of 
+        bags in top_dir to the index. """
+        top_dir = self.top_dir_key(top_dir)
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT INTO files (top_dir, bag, path, size, quick, digest) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", [(top_dir, sqlite3.Binary(f["bag"]), sqlite3.Binary(f["path"]), \
+                    f["size"], f["quick"], f["digest"]) for f in files])
 
-    for file_or_dir in dfList:
-        rename = remove_special_characters(file_or_dir)
-        if os.path.isfile(file_or_dir):
+    def update_indexed(self, files):
+        """ Saves the hashes of files from indexed_files(). """
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("UPDATE files SET quick = ?, digest = ? WHERE id = ?", \
+                    [(f["quick"], f["digest"], f["id"]) for f in files])
+
+    def unindex_bag(self, top_dir, bag):
+        """ Removes the files of the bag called bag, in top_dir, from the index. """
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM files WHERE bag = ? AND top_dir IS ?", \
+                    (sqlite3.Binary(name_bytes(bag)), self.top_dir_key(top_dir)))
+
+    def top_dir_key(self, top_dir):
+        """ Returns what files of bags in top_dir are indexed under. """
+        if not self.shared:
+            return None
+        return sqlite3.Binary(name_bytes(os.path.abspath(top_dir)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# The stage being recorded by a RunReport in each thread, see count_call(). 
+# FileOps.concurrently() lends it to its pool threads, hence the lock.
+current_stage = threading.local()
+count_lock = threading.Lock()
+
+def count_call(call, n=1):
+    """ Adds n file system calls of the given kind to the stage being recorded 
+    in this thread, if there is one. """
+    record = getattr(current_stage, "record", None)
+    if record is not None:
+        with count_lock:
+            record["calls"][call] = record["calls"].get(call, 0) + n
+
+def count_processed(files=0, size=0):
+    """ Adds files and size bytes to the files and bytes processed by the stage 
+    being recorded in this thread, if there is one. """
+    record = getattr(current_stage, "record", None)
+    if record is not None:
+        with count_lock:
+            record["files"] += files
+            record["bytes"] += size
+
+class FileOps:
+    """ The file system calls made while accessioning bags, counted with 
+    count_call() under the kind of call the run report lists: listdir, stat, 
+    mkdir, rename, move or open. 
+    On network shares each call waits a round trip, so calls that don't depend 
+    on each other are run through concurrently(), up to workers at a time. """
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.pool, self.pool_lock = None, threading.Lock()
+
+    def concurrently(self, method, args_list, errors=False):
+        """ Runs method(*args) for each args in args_list, up to self.workers at 
+        a time, and returns the results in the order of args_list. The calls 
+        must not depend on each other, they run in any order. Calls are counted 
+        against the stage of the calling thread. If errors is True, a call that 
+        fails gives its exception as its result; otherwise the first one is 
+        raised once all calls are done. """
+        def run(args):
             try:
-                shutil.move(os.path.join(root, file_or_dir),os.path.join(root, rename))
-            except:
-                print 'error with file', os.path.join(root, file_or_dir)
-        if os.path.isdir(file_or_dir):
+                return method(*args)
+            except (OSError, IOError, shutil.Error) as error:
+                if not errors:
+                    raise
+                return error
+        if self.workers <= 1 or len(args_list) <= 1:
+            return [run(args) for args in args_list]
+        record = getattr(current_stage, "record", None)
+        def run_in_pool(args):
+            current_stage.record = record
+            try:
+                return run(args)
+            finally:
+                current_stage.record = None
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        return self.pool.map(run_in_pool, args_list)
+
+    def close(self, terminate=False):
+        """ Closes the pool of concurrently(), or with terminate, stops it 
+        without waiting. """
+        with self.pool_lock:
+            if self.pool is not None:
+                if terminate:
+                    self.pool.terminate()
+                else:
+                    self.pool.close()
+                    self.pool.join()
+                self.pool = None
+
+    def list_dir(self, dir_path, prune=None):
+        """ Lists dir_path for scan_tree(): returns (name, is_dir, entry) for 
+        each of its entries, where entry is handed to stat_entry(). With scandir, 
+        the listing gives is_dir, and folders prune() returns True for get None 
+        for entry, they aren't stat'ed. Without, is_dir is None until 
+        stat_entry() has lstat'ed the entry's path. """
+        entries = []
+        if scandir is not None:
+            for entry in self.scandir(dir_path):
+                name, is_dir = entry.name, entry.is_dir(follow_symlinks=False)
+                if is_dir and prune is not None and prune(name):
+                    entry = None
+                entries.append((name, is_dir, entry))
+        else:
+            for name in self.listdir(dir_path):
+                entries.append((name, None, os.path.join(dir_path, name)))
+        return entries
+
+    def stat_entry(self, entry):
+        """ Returns (is_dir, is_link, size, mtime, inode) for an entry from 
+        list_dir(). Symlinks are not followed. """
+        count_call("stat")
+        if isinstance(entry, basestring):
+            st = os.lstat(entry)
+            return stat.S_ISDIR(st.st_mode), stat.S_ISLNK(st.st_mode), st.st_size, st.st_mtime, st.st_ino
+        st = entry.stat(follow_symlinks=False)
+        return entry.is_dir(follow_symlinks=False), entry.is_symlink(), st.st_size, st.st_mtime, entry.inode()
+
+    def listdir(self, path):
+        count_call("listdir")
+        return os.listdir(path)
+
+    def scandir(self, path):
+        count_call("listdir")
+        return scandir(path)
+
+    def stat(self, path):
+        count_call("stat")
+        return os.stat(path)
+
+    def lstat(self, path):
+        count_call("stat")
+        return os.lstat(path)
+
+    def exists(self, path):
+        count_call("stat")
+        return os.path.exists(path)
+
+    def isfile(self, path):
+        count_call("stat")
+        return os.path.isfile(path)
+
+    def mkdir(self, path):
+        count_call("mkdir")
+        os.mkdir(path)
+
+    def rename(self, src, dst):
+        count_call("rename")
+        os.rename(src, dst)
+
+    def move(self, src, dst):
+        count_call("move")
+        shutil.move(src, dst)
+
+    def readlink(self, path):
+        count_call("stat")
+        return os.readlink(path)
+
+    def open(self, path, mode="rb"):
+        count_call("open")
+        return open(path, mode)
+
+fs = FileOps(workers=8)
+
+class RunReport:
+    """ Records, for each bag and each stage of accessioning it, the wall time, 
+    the file system calls made (see FileOps), the files and bytes processed and 
+    the throughput. Given a path ending in .jsonl, each stage is written to it 
+    as a line of JSON as soon as it's over, and a summary of the run last; any 
+    other path gets the whole report as one JSON document by close(). With 
+    progress, a progress line with the time left is kept up to date on stderr. """
+    def __init__(self, path=None, progress=False):
+        self.path, self.progress = path, progress
+        self.records = []
+        self.lock = threading.Lock()
+        self.started = self.bags_started = time.time()
+        self.bags_total, self.bags_done, self.workers = 0, 0, 1
+        # kept as the scan stages finish, so the progress line needn't go over every record
+        self.files_scanned = 0
+        self.stream = None
+        if path is not None and path.endswith(".jsonl"):
+            self.stream = open(path, "w")
+
+    def start(self, bags_total, workers):
+        """ Called once the bags to accession are known. """
+        self.bags_total, self.workers = bags_total, workers
+        self.bags_started = time.time()
+        self.show_progress()
+
+    @contextlib.contextmanager
+    def stage(self, item, stage):
+        """ Records the code run in the with block, in this thread, as the given 
+        stage of accessioning item (None for the run as a whole). """
+        record = {"bag": None if item is None else decode_name(item), "stage": stage, \
+            "calls": {}, "files": 0, "bytes": 0}
+        outer = getattr(current_stage, "record", None)
+        current_stage.record = record
+        start = time.time()
+        try:
+            yield record
+        finally:
+            current_stage.record = outer
+            record["seconds"] = time.time() - start
+            record["files_per_second"] = record["files"] / record["seconds"] if record["seconds"] else None
+            record["bytes_per_second"] = record["bytes"] / record["seconds"] if record["seconds"] else None
+            with self.lock:
+                self.records.append(record)
+                if stage == "scan":
+                    self.files_scanned += record["files"]
+                if self.stream is not None:
+                    self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+                    self.stream.flush()
+                self.show_progress()
+
+    def bag_done(self):
+        """ Called as each bag is finished. """
+        with self.lock:
+            self.bags_done += 1
+            self.show_progress()
+
+    def show_progress(self):
+        """ Rewrites the progress line on stderr: bags done, files scanned so 
+        far, and the time left, going by the time the bags done took. """
+        if not self.progress:
+            return
+        elapsed = time.time() - self.bags_started
+        left = "?"
+        if self.bags_done:
+            left = format_seconds(elapsed / self.bags_done * (self.bags_total - self.bags_done))
+        sys.stderr.write("\r%d/%d bags, %d files scanned, %s elapsed, %s left   " % (self.bags_done, \
+            self.bags_total, self.files_scanned, format_seconds(elapsed), left))
+        sys.stderr.flush()
+
+    def summary(self):
+        """ Returns the totals of the run, and of each stage over all bags. """
+        stages, calls = {}, {}
+        for record in self.records:
+            totals = stages.setdefault(record["stage"], {"seconds": 0.0, "count": 0, "calls": {}, "files": 0, "bytes": 0})
+            totals["seconds"] += record["seconds"]
+            totals["count"] += 1
+            totals["files"] += record["files"]
+            totals["bytes"] += record["bytes"]
+            for call, n in record["calls"].items():
+                totals["calls"][call] = totals["calls"].get(call, 0) + n
+                calls[call] = calls.get(call, 0) + n
+        return {"stage": "run", "started": str(datetime.datetime.fromtimestamp(self.started)), \
+            "seconds": time.time() - self.started, "bags": self.bags_done, "workers": self.workers, \
+            "calls": calls, "stages": stages}
+
+    def close(self):
+        """ Finishes the progress line and the report. """
+        if self.progress:
+            sys.stderr.write("\n")
+        if self.stream is not None:
+            self.stream.write(json.dumps(self.summary(), sort_keys=True) + "\n")
+            self.stream.close()
+        elif self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump({"run": self.summary(), "stages": self.records}, f, indent=2, sort_keys=True)
+
+class FolderWatcher:
+    """ Waits for something to arrive in, leave or change in a folder (not its 
+    subfolders), through inotify on Linux. Elsewhere, or where inotify can't be 
+    set up, wait() just sleeps; inotify doesn't see changes made from other 
+    machines on a network share either, so callers poll as well. """
+    def __init__(self, path):
+        self.fd = None
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, path.encode(sys.getfilesystemencoding() or "utf-8") \
+            if isinstance(path, unicode) else path, mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """ Returns after timeout seconds, or sooner if the folder changes. """
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        if select.select([self.fd], [], [], timeout)[0]:
+            # the events only wake us, what changed is found by listing the folder
             try:
-                # if statement: renames name w/ bad chars, and if rename exists 
-                # already, gives it an index. Not perfect.       
-                if not os.path.join(root, rename) == file_or_dir:
-                    rename = path_already_exists(os.path.join(root, rename))
-                shutil.move(os.path.join(root, file_or_dir), os.path.join(root, rename))
-                rec_traverse_dir(rename, root)
-            except:
-                print 'error with folder', os.path.join(root, file_or_dir)
-
-def remove_special_characters(value):
-    """ Given a string, removes the characters specified in deletechars and returns 
-    the new value. At the time of writing, the primary goal was to remove registered 
-    trademark symbols (®) from path names. Python and Windows CMD (not sure about 
-    Unix) cannot interpret these symbols, and so, the loss of these symbols is not 
-    reflected in renames.csv. The header: 
-        #!/usr/bin/env python 
-        # -*- coding: utf-8 -*-
-    is necessary for python to interpret these symbols. 
-    See http://stackoverflow.com/q/1033424/3889452 and http://stackoverflow.com/a/25067408/3889452 """
-    deletechars = '®©™'
-    for c in deletechars:
-        value = value.replace(c, '')
-    return value
+                while os.read(self.fd, 65536):
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def format_seconds(seconds):
+    """ Returns seconds as h:mm:ss. """
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def tree_fingerprint(bag_tree):
+    """ Returns a digest of the path, mtime and size of every file in the 
+    scanned tree, and the path of every folder, independent of the order it was 
+    listed in. Folders' mtimes change as the accessioner renames what's in 
+    them, after the scan, so they're left out, and so are inodes, which change 
+    when a tree is copied or restored. Mtimes are taken to the whole second, 
+    which is all that copies and restores reliably keep. 
+    Each entry is hashed on its own and the hashes added up (modulo 2**128), 
+    so the order doesn't matter and nothing but the folders still to be 
+    walked is held. """
+    total = 0
+    stack = [("", bag_tree)]
+    while stack:
+        dir_path, dir_node = stack.pop()
+        for node in dir_node.iter_children():
+            path = os.path.join(dir_path, decode_name(node.name))
+            if node.is_dir:
+                line = path
+                stack.append((path, node))
+            else:
+                line = u"%s\0%d\0%d" % (path, node.mtime, node.size)
+            total += int(hashlib.md5(line.encode('utf-8')).hexdigest(), 16)
+    return "%032x" % (total % 2**128)
+
+class ExclusionMatcher:
+    """ Decides whether a file or folder name is excluded, from the EXCLUDES, 
+    EXCLUDE_REGEX and EXCLUDE_GLOBS settings. Built once: exact names go in a 
+    set, and the regular expressions and glob patterns are compiled into a 
+    single alternation, so a name is checked with one lookup and one search. """
+    def __init__(self, names=(), regexes=(), globs=()):
+        self.names = set(name for name in names if name)
+        patterns = ["(?:%s)" % regex for regex in regexes if regex]
+        # globs match the whole name, regular expressions anywhere in it (re.search)
+        patterns += ["^(?:%s)" % glob_to_regex(glob) for glob in globs if glob]
+        self.pattern = None
+        if patterns:
+            self.pattern = re.compile("|".join(patterns))
+
+    def matches(self, name):
+        """ Returns True if name is excluded. """
+        if name in self.names:
+            return True
+        return self.pattern is not None and self.pattern.search(name) is not None
+
+def glob_to_regex(glob):
+    """ Returns fnmatch.translate(glob) without its trailing flags, which have 
+    to come first once it is part of a larger expression. """
+    regex = fnmatch.translate(glob)
+    if regex.endswith("(?ms)"):
+        regex = regex[:-len("(?ms)")]
+    return regex
+
+class BagTree:
+    """ The files and folders found by scan_tree(), stored compactly for bags of 
+    millions of files. Each entry is an index into arrays holding its parent, 
+    first and last child, next sibling, flags, size, mtime and inode, so no 
+    object is kept per entry; names are kept once, interned, so a name repeated 
+    across folders (data, Thumbs.db, Photos) is stored once. Paths are never 
+    stored, they are put together while walking. Entry 0 is the root. 
+    TreeNode is the view of an entry the rest of the accessioner works with. 
+    Symlinks are entries of their own, flagged IS_LINK, with the size and 
+    mtime of the link rather than of what it points to. """
+    IS_DIR, PRUNED, IS_LINK = 1, 2, 4
+
+    def __init__(self, root_name):
+        self.names = []
+        # interned names, byte strings and unicode kept apart so joining paths never mixes them
+        self.byte_names, self.unicode_names = {}, {}
+        self.parents = array.array("i")
+        self.first_child = array.array("i")
+        self.last_child = array.array("i")
+        self.next_sibling = array.array("i")
+        self.flags = array.array("B")
+        # doubles hold sizes and inodes beyond 32 bits on every platform
+        self.sizes = array.array("d")
+        self.mtimes = array.array("d")
+        self.inodes = array.array("d")
+        self.add(-1, root_name, True)
+
+    def intern(self, name):
+        """ Returns the stored copy of name, storing it if it's new. """
+        names = self.unicode_names if isinstance(name, unicode) else self.byte_names
+        return names.setdefault(name, name)
+
+    def add(self, parent, name, is_dir, size=0, mtime=0, inode=0):
+        """ Adds an entry as the last child of the entry parent (-1 for the 
+        root) and returns its index. """
+        index = len(self.names)
+        self.names.append(self.intern(name))
+        self.parents.append(parent)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.flags.append(self.IS_DIR if is_dir else 0)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.inodes.append(inode)
+        if parent >= 0:
+            self.link(parent, index)
+        return index
+
+    def link(self, parent, index):
+        """ Makes the entry index the last child of parent. """
+        self.parents[index] = parent
+        if self.last_child[parent] < 0:
+            self.first_child[parent] = index
+        else:
+            self.next_sibling[self.last_child[parent]] = index
+        self.last_child[parent] = index
+
+    def unlink(self, index):
+        """ Takes the entry index (and everything below it) out of its parent's 
+        children. """
+        parent = self.parents[index]
+        previous, child = -1, self.first_child[parent]
+        while child != index:
+            previous, child = child, self.next_sibling[child]
+        if previous < 0:
+            self.first_child[parent] = self.next_sibling[index]
+        else:
+            self.next_sibling[previous] = self.next_sibling[index]
+        if self.last_child[parent] == index:
+            self.last_child[parent] = previous
+        self.next_sibling[index] = -1
+
+    def children(self, index):
+        """ Yields the indexes of the children of the entry index. """
+        child = self.first_child[index]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def root(self):
+        return TreeNode(self, 0)
+
+class TreeNode(object):
+    """ A file or folder of a BagTree. Folders have children, files the size 
+    and modification time read during the walk. Pruned folders were excluded 
+    and not walked, so they have no children. Nodes are views made as they 
+    are needed, holding nothing but the tree and the entry's index. """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree, self.index = tree, index
+
+    def __eq__(self, other):
+        return isinstance(other, TreeNode) and self.tree is other.tree and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def get_name(self):
+        return self.tree.names[self.index]
+
+    def set_name(self, name):
+        self.tree.names[self.index] = self.tree.intern(name)
+
+    name = property(get_name, set_name)
+    is_dir = property(lambda self: bool(self.tree.flags[self.index] & BagTree.IS_DIR))
+    is_link = property(lambda self: bool(self.tree.flags[self.index] & BagTree.IS_LINK))
+    size = property(lambda self: self.tree.sizes[self.index])
+    mtime = property(lambda self: self.tree.mtimes[self.index])
+    inode = property(lambda self: int(self.tree.inodes[self.index]))
+
+    def get_pruned(self):
+        return bool(self.tree.flags[self.index] & BagTree.PRUNED)
+
+    def set_pruned(self, pruned):
+        if pruned:
+            self.tree.flags[self.index] |= BagTree.PRUNED
+        else:
+            self.tree.flags[self.index] &= ~BagTree.PRUNED
+
+    pruned = property(get_pruned, set_pruned)
+
+    @property
+    def children(self):
+        """ The child nodes, as a list. iter_children() doesn't make the list. """
+        return list(self.iter_children())
+
+    def iter_children(self):
+        """ Yields the child nodes one at a time. """
+        tree = self.tree
+        for index in tree.children(self.index):
+            yield TreeNode(tree, index)
+
+    def child(self, name):
+        """ Returns the child node called name, or None. """
+        tree = self.tree
+        for index in tree.children(self.index):
+            if tree.names[index] == name:
+                return TreeNode(tree, index)
+        return None
+
+    def find(self, rel_path):
+        """ Returns the node at rel_path, relative to this node, or None. """
+        node = self
+        for part in rel_path.split(os.sep):
+            node = node.child(part)
+            if node is None:
+                return None
+        return node
+
+    def make_dir(self, rel_path):
+        """ Adds an empty folder at rel_path, relative to this node. """
+        parent, name = os.path.split(rel_path)
+        dir_node = self.find(parent) if parent else self
+        self.tree.add(dir_node.index, name, True)
+
+    def move(self, rel_path, new_rel_path):
+        """ Moves the node at rel_path to new_rel_path, both relative to this 
+        node, in the tree only. """
+        parent, name = os.path.split(rel_path)
+        node = (self.find(parent) if parent else self).child(name)
+        self.tree.unlink(node.index)
+        parent, node.name = os.path.split(new_rel_path)
+        self.tree.link((self.find(parent) if parent else self).index, node.index)
+
+    def add_file(self, rel_path, st):
+        """ Adds (or updates) the file at rel_path, relative to this node, using 
+        the os.stat() result st. Folders on the way must already be in the tree. """
+        dir_node = self
+        parts = rel_path.split(os.sep)
+        for part in parts[:-1]:
+            dir_node = dir_node.child(part)
+        node = dir_node.child(parts[-1])
+        if node is None:
+            node = TreeNode(self.tree, self.tree.add(dir_node.index, parts[-1], False))
+        self.tree.sizes[node.index] = st.st_size
+        self.tree.mtimes[node.index] = st.st_mtime
+        self.tree.inodes[node.index] = st.st_ino
+
+    def walk(self, rel_path):
+        """ Yields (path, node) for every file and folder below this node, where 
+        path is rel_path joined with the names on the way to it. rel_path is 
+        the path of this node. Streams: only the paths of the folders still to 
+        be walked are held. """
+        tree = self.tree
+        stack = [(rel_path, self.index)]
+        while stack:
+            dir_path, dir_index = stack.pop()
+            for index in tree.children(dir_index):
+                path = os.path.join(dir_path, tree.names[index])
+                if tree.flags[index] & BagTree.IS_DIR:
+                    stack.append((path, index))
+                yield path, TreeNode(tree, index)
+
+    def iter_files(self, rel_path):
+        """ Same as walk(), for files only. """
+        for path, node in self.walk(rel_path):
+            if not node.is_dir:
+                yield path, node
+
+def scan_tree(root_path, prune=None):
+    """ Walks root_path once and returns a BagTree, as its root TreeNode, holding 
+    the name, type, size, mtime and inode of every file and folder below it. Uses os.scandir 
+    (or the scandir package) when available so the directory listing supplies 
+    the file types, and stats each entry exactly once. Symlinks are not followed. 
+    Folders whose name prune() returns True for are kept as pruned nodes, but 
+    not stat'ed (with scandir) or descended into. 
+    The tree is walked a level at a time: the folders of a level are listed, 
+    then all of their entries stat'ed, each through fs.concurrently(). """
+    tree = BagTree(os.path.basename(root_path))
+    level = [(root_path, 0)]
+    while level:
+        listings = fs.concurrently(fs.list_dir, [(dir_path, prune) for dir_path, dir_index in level])
+        stats = iter(fs.concurrently(fs.stat_entry, \
+            [(entry,) for listing in listings for name, is_dir, entry in listing if entry is not None]))
+        next_level = []
+        for (dir_path, dir_index), listing in zip(level, listings):
+            for name, is_dir, entry in listing:
+                if entry is None:
+                    tree.flags[tree.add(dir_index, name, True)] |= BagTree.PRUNED
+                    continue
+                is_dir, is_link, size, mtime, inode = next(stats)
+                index = tree.add(dir_index, name, is_dir, size, mtime, inode)
+                if is_link:
+                    tree.flags[index] |= BagTree.IS_LINK
+                if not is_dir:
+                    count_processed(files=1, size=size)
+                elif prune is not None and prune(name):
+                    # without scandir, folders are only known to be folders once stat'ed
+                    tree.flags[index] |= BagTree.PRUNED
+                else:
+                    next_level.append((os.path.join(dir_path, name), index))
+        level = next_level
+    return tree.root()
+
+def hash_file(path, algorithms, chunk_size=1048576):
+    """ Reads the file at path once, in chunks of chunk_size bytes, and returns 
+    a dictionary of algorithm name to hex digest for each algorithm given. """
+    hashes = [(alg, hashlib.new(alg)) for alg in algorithms]
+    with open(path, "rb") as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            for alg, h in hashes:
+                h.update(chunk)
+            chunk = f.read(chunk_size)
+    return {alg:h.hexdigest() for alg, h in hashes}
+
+# File formats identify_format() knows, by the bytes their files start with, as 
+# regular expressions matched at the start of the head, tried in order (so the 
+# more specific ones come first). Bump FORMAT_SIGNATURES_VERSION when changing 
+# them, so formats cached in journals are identified again.
+FORMAT_SIGNATURES = [
+    ("PDF", r"%PDF-"),
+    ("PostScript", r"%!PS"),
+    ("JPEG", r"\xff\xd8\xff"),
+    ("PNG", r"\x89PNG\r\n\x1a\n"),
+    ("GIF", r"GIF8[79]a"),
+    ("Canon RAW", r"II\*\x00.{4}CR"),
+    ("TIFF", r"II\*\x00|MM\x00\*"),
+    ("BMP", r"BM.{12}[\x0c\x28\x38\x40\x6c\x7c]\x00\x00\x00"),
+    ("JPEG 2000", r"\x00\x00\x00\x0cjP  \r\n\x87\n|\xff\x4f\xff\x51"),
+    ("Photoshop", r"8BPS\x00[\x01\x02]"),
+    ("DjVu", r"AT&TFORM"),
+    ("DICOM", r".{128}DICM"),
+    ("WebP", r"RIFF.{4}WEBP"),
+    ("WAV", r"RIFF.{4}WAVE"),
+    ("AVI", r"RIFF.{4}AVI "),
+    ("AIFF", r"FORM.{4}AIF[FC]"),
+    ("MP3", r"ID3[\x02-\x04]\x00|\xff[\xfb\xf3\xf2]"),
+    ("FLAC", r"fLaC"),
+    ("Ogg", r"OggS\x00"),
+    ("QuickTime", r".{4}ftypqt  |\x00.{3}(?:moov|mdat|wide|free)"),
+    ("MPEG-4", r".{4}ftyp"),
+    ("Matroska", r"\x1a\x45\xdf\xa3"),
+    ("MPEG", r"\x00\x00\x01[\xba\xb3]"),
+    ("Windows Media", r"0&\xb2u\x8ef\xcf\x11"),
+    ("Flash Video", r"FLV\x01"),
+    ("OpenDocument", r"PK\x03\x04.{26}mimetypeapplication/vnd\.oasis\.opendocument"),
+    ("EPUB", r"PK\x03\x04.{26}mimetypeapplication/epub\+zip"),
+    ("Office Open XML", r"PK\x03\x04.{26}(?:\[Content_Types\]\.xml|_rels/\.rels)"),
+    ("ZIP", r"PK\x03\x04|PK\x05\x06"),
+    ("RAR", r"Rar!\x1a\x07"),
+    ("7-Zip", r"7z\xbc\xaf\x27\x1c"),
+    ("gzip", r"\x1f\x8b"),
+    ("bzip2", r"BZh[1-9]1AY&SY"),
+    ("xz", r"\xfd7zXZ\x00"),
+    ("tar", r".{257}ustar"),
+    ("Microsoft Office (OLE2)", r"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"),
+    ("WordPerfect", r"\xffWPC"),
+    ("RTF", r"\{\\rtf"),
+    ("XML", r"(?:\xef\xbb\xbf)?<\?xml"),
+    ("HTML", r"(?:\xef\xbb\xbf)?\s*<(?:!DOCTYPE [Hh][Tt][Mm][Ll]|!doctype html|[Hh][Tt][Mm][Ll])"),
+    ("SQLite", r"SQLite format 3\x00"),
+    ("Windows executable", r"MZ.[\x00\x01]"),
+    ("ELF executable", r"\x7fELF"),
+    ("Text (UTF-16)", r"\xff\xfe|\xfe\xff"),
+]
+FORMAT_SIGNATURES_VERSION = 1
+# one expression for the whole table, the group that matched gives the format
+FORMAT_PATTERN = re.compile("|".join("(%s)" % pattern for name, pattern in FORMAT_SIGNATURES), re.DOTALL)
+# bytes read from the start of each file, enough for every signature
+FORMAT_HEAD_SIZE = 4096
+# files identified at a time, their heads held in memory together
+FORMAT_BATCH_SIZE = 500
+# bytes found in text files, the rest (NUL and most control characters) only in binary ones
+TEXT_BYTES = "".join(chr(c) for c in [7, 8, 9, 10, 12, 13, 27] + range(0x20, 0x7f) + range(0x80, 0x100))
+
+def identify_format(head):
+    """ Returns the format of a file from its first bytes, head: the first of 
+    FORMAT_SIGNATURES it matches, otherwise "Text" if it holds no binary bytes, 
+    "Empty" if it's empty and "Unknown" if it's none of these. """
+    if not head:
+        return "Empty"
+    match = FORMAT_PATTERN.match(head)
+    if match is not None:
+        return FORMAT_SIGNATURES[match.lastindex - 1][0]
+    if not head.translate(None, TEXT_BYTES):
+        return "Text"
+    return "Unknown"
+
+def read_head(path, size=FORMAT_HEAD_SIZE):
+    """ Returns the first size bytes of the file at path. """
+    with fs.open(path) as f:
+        return f.read(size)
+
+# BagIt tag files, left at the root of a bag whatever the settings exclude (manifests 
+# may have been written for any algorithm hashlib has), see plan_bag_structure()
+BAGIT_TAG_FILE = re.compile(r"(bagit|bag-info|(tag)?manifest-\w+)\.txt$")
+# Files the accessioner writes in a bag's data folder, see payload_files()
+ACCESSIONER_FILES = [os.path.join("data", "meta", "renames.csv"), os.path.join("data", "meta", "duplicates.csv")]
+# bytes read from each end of a file by quick_hash()
+DUPLICATE_BLOCK_SIZE = 65536
+
+def quick_hash(path, size, block_size=DUPLICATE_BLOCK_SIZE):
+    """ Returns a SHA-1 hash of the first and last block_size bytes of the file 
+    at path, size bytes long, and its SHA-256 digest if that is the whole file 
+    (None otherwise). """
+    with fs.open(path) as f:
+        if size <= 2 * block_size:
+            data = f.read()
+            return hashlib.sha1(data).hexdigest(), hashlib.sha256(data).hexdigest()
+        h = hashlib.sha1(f.read(block_size))
+        f.seek(-block_size, os.SEEK_END)
+        h.update(f.read(block_size))
+        return h.hexdigest(), None
+
+def name_bytes(name):
+    """ Returns name as bytes: unicode names (the only kind on Windows) are 
+    encoded to UTF-8, byte names are left as they are on disk. """
+    if isinstance(name, unicode):
+        return name.encode("utf-8")
+    return name
+
+def index_path(top_dir, bag, path):
+    """ Returns the path of the file in the duplicate index at path in bag, 
+    both bytes from name_bytes(). """
+    if sys.platform == 'win32' or platform.system() == 'Windows':
+        return os.path.join(decode_name(top_dir), bag.decode("utf-8"), path.decode("utf-8"))
+    return os.path.join(name_bytes(top_dir), bag, path)
+
+# bytes of the tar stream compressed at a time by package_bag()
+PACKAGE_BLOCK_SIZE = 1048576
+
+def tar_blocks(entries, block_size=PACKAGE_BLOCK_SIZE):
+    """ Yields the tar stream (GNU format) of entries, from package_entries(), 
+    in blocks of about block_size bytes, each with the number of files and 
+    bytes read for it. Files are read once, in chunks; symlinks are stored as 
+    links, never followed; names are written as they are on disk. """
+    def pieces():
+        total = 0
+        for arcname, path, entry_type, size, mtime in entries:
+            info = tarfile.TarInfo(arcname)
+            info.mtime, info.type = int(mtime), entry_type
+            if entry_type == tarfile.DIRTYPE:
+                info.mode = 0755
+            elif entry_type == tarfile.SYMTYPE:
+                info.mode, info.linkname = 0777, name_bytes(fs.readlink(path))
+            else:
+                info.size, info.mode = size, 0644
+            header = info.tobuf(tarfile.GNU_FORMAT)
+            yield header, 0, 0
+            total += len(header)
+            if entry_type != tarfile.REGTYPE:
+                continue
+            with fs.open(path) as f:
+                remaining = size
+                while remaining:
+                    chunk = f.read(min(block_size, remaining))
+                    if not chunk:
+                        raise IOError("%s got shorter while being packaged" % path)
+                    remaining -= len(chunk)
+                    yield chunk, 0, len(chunk)
+            padding = -size % tarfile.BLOCKSIZE
+            yield "\0" * padding, 1, 0
+            total += size + padding
+        # two empty blocks end the archive, which is padded to a whole record
+        end = 2 * tarfile.BLOCKSIZE
+        yield "\0" * (end + -(total + end) % tarfile.RECORDSIZE), 0, 0
+
+    block, block_size_so_far, files, read = [], 0, 0, 0
+    for piece, piece_files, piece_read in pieces():
+        block.append(piece)
+        block_size_so_far += len(piece)
+        files, read = files + piece_files, read + piece_read
+        if block_size_so_far >= block_size:
+            yield "".join(block), files, read
+            block, block_size_so_far, files, read = [], 0, 0, 0
+    if block:
+        yield "".join(block), files, read
+
+def gzip_member(data, level=6):
+    """ Returns data compressed as a whole gzip member; members written one 
+    after another decompress as a single stream. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff" + compressor.compress(data) + compressor.flush() + \
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+def zstd_frame(data, level=3):
+    """ Returns data compressed as a zstd frame; like gzip members, frames 
+    written one after another decompress as a single stream. """
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+class ArchiveSink:
+    """ Writes the blocks of a package to path in one thread and hashes them 
+    (SHA-256) in another, so that writing and hashing overlap each other and 
+    whatever makes the blocks. put() waits once queue_size blocks are queued. """
+    def __init__(self, path, queue_size=8):
+        self.file = fs.open(path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.size, self.error = 0, None
+        self.queues = [Queue.Queue(queue_size), Queue.Queue(queue_size)]
+        self.threads = [threading.Thread(target=self.run, args=(self.queues[0], self.file.write)), \
+            threading.Thread(target=self.run, args=(self.queues[1], self.sha256.update))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def run(self, queue, consume):
+        while True:
+            block = queue.get()
+            if block is None:
+                return
+            # after an error, blocks are still taken off the queue so put() doesn't wait forever
+            if self.error is None:
+                try:
+                    consume(block)
+                except EnvironmentError as error:
+                    self.error = error
+
+    def put(self, block):
+        """ Queues block to be written and hashed. """
+        if self.error is not None:
+            raise self.error
+        self.size += len(block)
+        for queue in self.queues:
+            queue.put(block)
+
+    def close(self):
+        """ Waits for the blocks put to be written and hashed, closes the file 
+        and returns the checksum, as hex. """
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+        return self.sha256.hexdigest()
+
+def group_by(items, key):
+    """ Returns a dictionary of key(item) to the list of items with that key. """
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
+
+def bagit_path(rel_path):
+    """ Returns rel_path the way BagIt manifests list it: utf-8, with forward 
+    slashes. """
+    return decode_name(rel_path).replace(os.sep, "/").encode('utf-8')
+
+def snapshot(src, dst, mode="link"):
+    """ Makes dst a snapshot of the file or folder src for the debug option, so 
+    the accessioner can work on dst while src keeps its names and contents. 
+    Folders are recreated, and depending on mode files are: 
+        link: hard linked, so no data is copied. The accessioner only renames 
+            and moves the files it finds, and files it writes to are first 
+            given their own copy by unshare_file(). 
+        reflink: cloned (copy-on-write) where the filesystem supports it 
+        copy: copied, like shutil.copytree 
+    Files that can't be linked or cloned are copied, and so are the files the 
+    accessioner keeps in a top directory (see is_state_file()), which a run 
+    writes to in place. On Windows paths are handled as unicode, so names that 
+    aren't valid in the system code page still work. """
+    if isinstance(src, str) and os.path.supports_unicode_filenames:
+        src, dst = src.decode(sys.getfilesystemencoding() or 'utf-8'), dst.decode(sys.getfilesystemencoding() or 'utf-8')
+    if not os.path.isdir(src):
+        snapshot_file(src, dst, mode)
+        return
+    os.mkdir(dst)
+    stack = [(src, dst, scan_tree(src))]
+    while stack:
+        src_dir, dst_dir, dir_node = stack.pop()
+        for node in dir_node.iter_children():
+            src_path, dst_path = os.path.join(src_dir, node.name), os.path.join(dst_dir, node.name)
+            if node.is_dir:
+                os.mkdir(dst_path)
+                stack.append((src_path, dst_path, node))
+            elif src_dir == src and is_state_file(node.name):
+                shutil.copy2(src_path, dst_path)
+            else:
+                snapshot_file(src_path, dst_path, mode)
+    shutil.copystat(src, dst)
+
+def is_state_file(name):
+    """ Returns True if name is one of the files the accessioner keeps in a top 
+    directory: the journal (and SQLite's files next to it), the identifier 
+    reservations and the import templates. """
+    return name.startswith(AccessionJournal.journal_file_name) or \
+        name == BagIdentifierAllocator.reservation_file_name or \
+        re.match(r"ImportTemplate_\d{8}(_\d+)?\.csv$", name) is not None
+
+def snapshot_file(src, dst, mode):
+    """ Hard links, clones or copies the file src to dst, see snapshot(). """
+    if mode == "link" and hasattr(os, "link"):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # e.g. across devices, or no hard links on this filesystem
+            pass
+    elif mode == "reflink" and fcntl is not None:
+        try:
+            with open(src, "rb") as src_file:
+                with open(dst, "wb") as dst_file:
+                    fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (IOError, OSError):
+            # not a Linux filesystem with copy-on-write clones (btrfs, XFS, ...)
+            pass
+    shutil.copy2(src, dst)
+
+def unshare_file(path):
+    """ If the file at path is hard linked elsewhere (e.g. by a "link" snapshot), 
+    replaces it with a copy of its own, so writing to it leaves the other links 
+    alone. """
+    if fs.exists(path) and fs.stat(path).st_nlink > 1:
+        shutil.copy2(path, path + ".unshare")
+        os.remove(path)
+        fs.rename(path + ".unshare", path)
+
+# Characters deleted from names (®, which Windows CMD can't show, and the like), see NameCleanser
+SPECIAL_CHARACTERS = u'®©™'
+
+class NameCleanser:
+    """ Cleanses file and folder names in a single pass: one charmap encode to 
+    cp850 with a table where the characters to replace map to "_", and the 
+    SPECIAL_CHARACTERS are left out, so they are dropped along with anything 
+    cp850 can't encode. Results are cached, since the same names (Thumbs.db, 
+    Photos, data) turn up in folder after folder. """
+    cache_size = 100000
+
+    def __init__(self, chars_to_replace, chars_to_delete=SPECIAL_CHARACTERS):
+        self.encoding_map = dict(encodings.cp850.encoding_map)
+        for c in chars_to_delete:
+            self.encoding_map.pop(ord(c), None)
+        for c in chars_to_replace:
+            self.encoding_map[ord(c)] = ord("_")
+        self.cache = {}
+
+    def cleanse(self, name):
+        """ Returns the cleansed name, cp850 characters only, in the same type as 
+        name (see native_name()). """
+        cleansed = self.cache.get(name)
+        if cleansed is None:
+            cleansed = codecs.charmap_encode(decode_name(name), "ignore", self.encoding_map)[0]
+            if isinstance(name, unicode):
+                cleansed = cleansed.decode('cp850')
+            self.remember(name, cleansed)
+        return cleansed
+
+    def cleanse_names(self, names):
+        """ Returns the cleansed names of a list of names, such as a folder 
+        listing. Names not in the cache are joined and encoded in one pass, 
+        which works because no name can hold a NUL. """
+        cleansed_names = [self.cache.get(name) for name in names]
+        missing = [i for i, cleansed in enumerate(cleansed_names) if cleansed is None]
+        if missing:
+            joined = u"\0".join(decode_name(names[i]) for i in missing)
+            for i, cleansed in zip(missing, codecs.charmap_encode(joined, "ignore", self.encoding_map)[0].split("\0")):
+                if isinstance(names[i], unicode):
+                    cleansed = cleansed.decode('cp850')
+                cleansed_names[i] = cleansed
+                self.remember(names[i], cleansed)
+        return cleansed_names
+
+    def remember(self, name, cleansed):
+        # bounded, the cache starts over once it's full
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[name] = cleansed
+
+def native_name(name):
+    """ Returns name, cp850 bytes, in the type paths are kept in: unicode where 
+    the file system takes unicode names (Windows, OS X), bytes elsewhere, since 
+    listing a unicode path there gives byte names for names the file system 
+    encoding can't decode (any non-ascii name when LANG isn't set), and those 
+    can't be joined to a unicode path. """
+    if os.path.supports_unicode_filenames and isinstance(name, str):
+        return name.decode('cp850')
+    return name
+
+def cp850_name(name):
+    """ Returns a cleansed name (see NameCleanser), kept in either type, as the 
+    cp850 bytes renames.csv and the import template hold. """
+    if isinstance(name, unicode):
+        return name.encode('cp850')
+    return name
+
+def file_folder_path(file_path):
+    """ Returns the path of the folder accession_file() puts the file at 
+    file_path in: its name without the extension, dropping whatever cp850 can't 
+    encode. """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(os.path.dirname(file_path), native_name(decode_name(stem).encode('cp850', errors='ignore')))
+
+def decode_name(name):
+    """ Returns name as unicode. Listing a byte path gives byte names, which 
+    can't be encoded to cp850 directly if they hold non-ascii characters. """
+    if isinstance(name, str):
+        return name.decode('utf-8', 'replace')
+    return name
 
 def path_already_exists(path):
     """ Given a path, checks to see if it already exists. If it does, a new 
     with a corresponding index number (that counts up) is returned, such as 
     "/New_Folder_2". If it doesn't, the original path is returned. """
-    if os.path.exists(path):
+    if fs.exists(path):
         ext = ''
         if os.path.isfile(path):
             path, ext = os.path.splitext(path)
         rename_index = 1
-        while os.path.exists(path + "_" + str(rename_index) + ext):
+        while fs.exists(path + "_" + str(rename_index) + ext):
             rename_index += 1
         path = path + "_" + str(rename_index) + ext
     return path 
 
+def join_names(*names):
+    """ os.path.join() for names that may be a mix of unicode and byte 
+    strings. """
+    return os.path.join(*[decode_name(name) for name in names])
+
+def name_key(name):
+    """ Returns the key name is kept under in a folder's name index: two names 
+    with the same key can't be in the same folder. Case is folded whatever 
+    the platform, since bags may sit on case-insensitive storage. """
+    return decode_name(name).lower()
+
+def free_name(name, is_dir, names_taken, next_index):
+    """ Same as path_already_exists(), using names_taken, the name_key()s in use 
+    in a folder, instead of the disk. next_index remembers the last index given 
+    for each name, so the next clash with it doesn't count up from 1 again. 
+    An empty name (nothing was left after cleansing) is never free, so it 
+    becomes "_1", "_2" and so on. """
+    key = name_key(name)
+    if name and key not in names_taken:
+        return name
+    ext = ''
+    if not is_dir:
+        name, ext = os.path.splitext(name)
+    rename_index = next_index.get(key, 1)
+    while name_key(name + "_" + str(rename_index) + ext) in names_taken:
+        rename_index += 1
+    next_index[key] = rename_index + 1
+    return name + "_" + str(rename_index) + ext
+
 def usage_message():
     print "\ndata_accessioner: Cleanses a directory of files/dirs and places them in properly-formatted bags using the bagit specifications.\
     \n\nUsage:\
@@ -406,32 +2474,141 @@ def usage_message():
             \n\tpython data_accessioner.py -h | --help\
         \n\nOptions:\
             \n\t-h --help\tShow this screen.\
-            \n\t-d --debug\tCreates a new copy of the original folder or file.\
+            \n\t-d --debug\tWorks on a snapshot of the original folder or file.\
+            \n\t--snapshot=MODE\tHow the debug snapshot is made: link (hard links,\
+            \n\t\t\tthe default), reflink (copy-on-write clones) or copy.\
+            \n\t-w N --workers=N\tAccessions N bags at once (default 1).\
+            \n\t--io-workers=N\tRuns up to N independent file system calls at once\
+            \n\t\t\t(default 8), for storage where each call is slow.\
+            \n\t-m ALGS --manifest=ALGS\tWrites BagIt manifests using the comma separated\
+            \n\t\t\thash algorithms ALGS (e.g. md5,sha256).\
+            \n\t--report=FILE\tWrites the time, file system calls, files and bytes of\
+            \n\t\t\teach stage of each bag to FILE, as JSON (JSON lines if\
+            \n\t\t\tFILE ends in .jsonl).\
+            \n\t--progress\tShows a progress line with the time left on stderr.\
+            \n\t--recheck\tWalks the bags finished by earlier runs again, and\
+            \n\t\t\taccessions again the ones that have changed.\
+            \n\t--identify\tCounts the formats of each bag's files from their first\
+            \n\t\t\tbytes, in the import file's Physical Description.\
+            \n\t--dedupe\tLists the files of each bag that have copies, in the bag or\
+            \n\t\t\tin bags accessioned before, in data/meta/duplicates.csv.\
+            \n\t--dedupe-index=FILE\tKeeps the index of files --dedupe checks against in\
+            \n\t\t\tFILE instead of the journal, so that top directories\
+            \n\t\t\tsharing it see each other (implies --dedupe).\
+            \n\t--package=DIR\tStreams each finished bag into a tar file in DIR, its\
+            \n\t\t\tchecksum going in the import file's Comments.\
+            \n\t--compress=ALG\tWith --package, compresses the tar files with gzip or\
+            \n\t\t\tzstd (needs the zstandard package), in parallel.\
+            \n\t--dry-run=REPORT\tWrites the renames and moves accessioning would make\
+            \n\t\t\tto the csv file REPORT, without changing anything.\
+            \n\t--watch\tKeeps accessioning items as they are dropped into <path>,\
+            \n\t\t\tuntil interrupted with Ctrl-C.\
+            \n\t--settle=SECONDS\tWith --watch, how long an item must stay unchanged\
+            \n\t\t\tbefore it is accessioned (default 60).\
+            \n\t--poll=SECONDS\tWith --watch, how often items are checked (default 10).\
         \n\nDependency:\
             \n\taccession_settings.txt"
 
 def main():
     accessioner = DataAccessioner('accession_settings.txt')
 
-    if len(sys.argv) <= 1 or len(sys.argv) > 3 or sys.argv[1] == "-h" or sys.argv[1] == "--help":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hdw:m:", ["help", "debug", "snapshot=", "workers=", "manifest=", "dry-run=", "report=", "progress", "io-workers=", "watch", "settle=", "poll=", "recheck", "identify", "dedupe", "dedupe-index=", "package=", "compress="])
+    except getopt.GetoptError as err:
+        print '\n' + str(err),
         return usage_message()
-    elif len(sys.argv) == 2:
-        path_arg = sys.argv[1]
-    elif len(sys.argv) == 3:
-        path_arg = sys.argv[2]
+    opts = dict(opts)
+    if len(args) != 1 or "-h" in opts or "--help" in opts:
+        return usage_message()
+    path_arg = args[0]
+
+    try:
+        workers = int(opts.get("-w", opts.get("--workers", 1)))
+        fs.workers = int(opts.get("--io-workers", fs.workers))
+        settle = float(opts.get("--settle", 60))
+        poll_interval = float(opts.get("--poll", 10))
+    except ValueError:
+        print '\n--workers, --io-workers, --settle and --poll must be numbers',
+        return usage_message()
+
+    manifest_algorithms = opts.get("-m", opts.get("--manifest"))
+    if manifest_algorithms:
+        accessioner.manifest_algorithms = manifest_algorithms.lower().split(",")
+        for alg in accessioner.manifest_algorithms:
+            if alg not in hashlib.algorithms:
+                print '\nunknown manifest algorithm', alg,
+                return usage_message()
+
+    accessioner.recheck_finished = "--recheck" in opts
+    accessioner.identify_formats = "--identify" in opts
+    accessioner.detect_duplicates = "--dedupe" in opts or "--dedupe-index" in opts
+    accessioner.duplicate_index_path = opts.get("--dedupe-index", accessioner.duplicate_index_path)
+    if accessioner.detect_duplicates and accessioner.duplicate_index_path is not None and \
+        not os.path.isdir(os.path.dirname(os.path.abspath(accessioner.duplicate_index_path))):
+        print '\nthe folder of the duplicate index does not exist',
+        return usage_message()
+
+    if "--package" in opts:
+        if not os.path.isdir(opts["--package"]):
+            print '\n--package folder does not exist',
+            return usage_message()
+        accessioner.package_dir = opts["--package"]
+        accessioner.package_compression = opts.get("--compress")
+        if accessioner.package_compression not in (None, "gzip", "zstd"):
+            print '\nunknown compression', accessioner.package_compression,
+            return usage_message()
+        if accessioner.package_compression == "zstd" and zstandard is None:
+            print '\nzstd compression needs the zstandard package',
+            return usage_message()
+
+    snapshot_mode = opts.get("--snapshot", "link")
+    if snapshot_mode not in ("link", "reflink", "copy"):
+        print '\nunknown snapshot mode', snapshot_mode,
+        return usage_message()
+
+    if os.path.exists(path_arg) and "--dry-run" in opts:
+        accessioner.dry_run_bags_in_dir(path_arg, opts["--dry-run"])
+
+    elif os.path.isdir(path_arg) and "--watch" in opts:
+        if "--report" in opts:
+            accessioner.run_report = RunReport(opts.get("--report"))
+        try:
+            accessioner.watch_folder(path_arg, settle, poll_interval, workers)
+        except KeyboardInterrupt:
+            print "stopped watching", path_arg
+        finally:
+            if accessioner.run_report is not None:
+                accessioner.run_report.close()
 
-    if os.path.exists(path_arg):
-        if sys.argv[1] == "-d" or sys.argv[1] == "--debug":
+    elif os.path.exists(path_arg):
+        if "-d" in opts or "--debug" in opts or "--snapshot" in opts:
             timestamp = "_%s%02d%02d_%02d%02d%02d" % (accessioner.now.year, accessioner.now.day, \
             accessioner.now.month, accessioner.now.hour, accessioner.now.minute, accessioner.now.second)
-            shutil.copytree(path_arg, path_arg + timestamp)
+            start = time.time()
+            snapshot(path_arg, path_arg + timestamp, snapshot_mode)
+            print "snapshot (%s) of %s made in %.2f s" % (snapshot_mode, path_arg, time.time() - start)
             path_arg = path_arg + timestamp
+            # the shared duplicate index is written to as well, the snapshot gets a copy of its own
+            if accessioner.detect_duplicates and accessioner.duplicate_index_path is not None \
+                and os.path.isdir(path_arg):
+                index_copy = os.path.join(path_arg, DuplicateIndex.snapshot_file_name)
+                if os.path.exists(accessioner.duplicate_index_path):
+                    shutil.copy2(accessioner.duplicate_index_path, index_copy)
+                accessioner.duplicate_index_path = index_copy
 
-        rec_traverse_dir(path_arg, path_arg)
-        accessioner.accession_bags_in_dir(path_arg)
+        if "--report" in opts or "--progress" in opts:
+            accessioner.run_report = RunReport(opts.get("--report"), "--progress" in opts)
+        try:
+            accessioner.accession_bags_in_dir(path_arg, workers=workers)
+        except KeyboardInterrupt:
+            print "stopped, run again to pick up where it stopped"
+        finally:
+            if accessioner.run_report is not None:
+                accessioner.run_report.close()
 
     else:
         print '\n<path> does not exist',
         usage_message()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file